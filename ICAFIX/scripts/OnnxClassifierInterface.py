@@ -1,9 +1,43 @@
 import onnxruntime as ort
+import hashlib
 import os
 import numpy as np
 
+# names accepted for the graph optimization level and execution mode options
+optimization_levels = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+execution_modes = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
 class OnnxClassifier(object):
-    def __init__(self, model_name=None):
+    def __init__(self, model_name=None, intra_op_num_threads=None, inter_op_num_threads=None,
+                 graph_optimization_level="all", execution_mode="sequential",
+                 optimized_model_dir=None, profile_prefix=None):
+        """
+        model_name: onnx model file to load, names containing "ensemble" are loaded with load_model_ensemble
+        intra_op_num_threads, inter_op_num_threads: onnxruntime thread pool sizes, None for its defaults
+                    (all cores), e.g. 1 when many jobs share a node
+        graph_optimization_level: "disable", "basic", "extended" or "all"
+        execution_mode: "sequential" or "parallel" (independent nodes at the same time, uses inter_op threads)
+        optimized_model_dir: folder to keep optimized models in, later loads of the same model skip graph optimization
+        profile_prefix: write onnxruntime per-node profiling to f"{profile_prefix}_<date>.json" files, see end_profiling
+        """
+        if graph_optimization_level not in optimization_levels:
+            raise ValueError(f"unknown graph optimization level {graph_optimization_level}, use one of {list(optimization_levels)}")
+        if execution_mode not in execution_modes:
+            raise ValueError(f"unknown execution mode {execution_mode}, use one of {list(execution_modes)}")
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self.graph_optimization_level = graph_optimization_level
+        self.execution_mode = execution_mode
+        self.optimized_model_dir = optimized_model_dir
+        self.profile_prefix = profile_prefix
         self.model = None
         self.ensemble = False
         if model_name is not None:
@@ -12,12 +46,61 @@ class OnnxClassifier(object):
             else:
                 self.load_model(model_name)
 
+    def session_options(self):
+        """
+        onnxruntime session options from the settings of this classifier
+        """
+        options = ort.SessionOptions()
+        if self.intra_op_num_threads is not None:
+            options.intra_op_num_threads = self.intra_op_num_threads
+        if self.inter_op_num_threads is not None:
+            options.inter_op_num_threads = self.inter_op_num_threads
+        options.graph_optimization_level = optimization_levels[self.graph_optimization_level]
+        options.execution_mode = execution_modes[self.execution_mode]
+        if self.profile_prefix is not None:
+            options.enable_profiling = True
+            options.profile_file_prefix = self.profile_prefix
+        return options
+
+    def create_session(self, model_name):
+        """
+        creates an inference session, with optimized_model_dir the graph is optimized once and saved,
+        keyed by the model contents, the onnxruntime version and the optimization level
+        the saved model is optimized up to "extended", the "all" level adds hardware specific layout
+        changes that should not be shared between machines, they are applied again when it is loaded
+        """
+        options = self.session_options()
+        if self.optimized_model_dir is None or self.graph_optimization_level == "disable":
+            return ort.InferenceSession(model_name, options)
+
+        offline_level = "extended" if self.graph_optimization_level == "all" else self.graph_optimization_level
+        h = hashlib.sha1()
+        with open(model_name, "rb") as f:
+            h.update(f.read())
+        h.update(f"{ort.__version__} {offline_level}".encode())
+        base = os.path.basename(model_name).replace(".onnx", "")
+        optimized_name = os.path.join(self.optimized_model_dir, f"{base}.{h.hexdigest()}.onnx")
+        if not os.path.exists(optimized_name):
+            # optimize into a temporary file and rename, so concurrent jobs never load a partial model
+            os.makedirs(self.optimized_model_dir, exist_ok=True)
+            tmp_name = f"{optimized_name}.{os.getpid()}.tmp"
+            offline_options = self.session_options()
+            offline_options.graph_optimization_level = optimization_levels[offline_level]
+            offline_options.optimized_model_filepath = tmp_name
+            offline_options.enable_profiling = False
+            ort.InferenceSession(model_name, offline_options)
+            os.replace(tmp_name, optimized_name)
+
+        if self.graph_optimization_level != "all":
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return ort.InferenceSession(optimized_name, options)
+
     def load_model(self, model_name):
         """
         loads an onnx model from file
         model_name: path to the model file
         """
-        self.model = ort.InferenceSession(model_name)
+        self.model = self.create_session(model_name)
         self.ensemble = False
 
     def load_model_ensemble(self, model_name):
@@ -25,12 +108,18 @@ class OnnxClassifier(object):
         loads many onnx model from files and ensemble them
         model_name: prefix for model file, the full model name should be f"{model_name}_{idx}.onnx"
                     we allow model_name include .onnx extension and the script will remove it
+                    the members are read from idx 1 on, f"{model_name}_0.onnx" is not part of the ensemble
+        a fused ensemble f"{model_name}.onnx" (convertJoblibToOnnxModel.py --fuse_ensemble), which
+        averages the members inside its graph, is loaded as a single model instead
         """
         models = []
         model_name = model_name.replace(".onnx", "")
+        if os.path.exists(f"{model_name}.onnx"):
+            self.load_model(f"{model_name}.onnx")
+            return
         for i in range(1, 1000):
             if os.path.exists(f"{model_name}_{i}.onnx"):
-                models.append(ort.InferenceSession(f"{model_name}_{i}.onnx"))
+                models.append(self.create_session(f"{model_name}_{i}.onnx"))
             else:
                 break
             if i == 999:
@@ -38,26 +127,38 @@ class OnnxClassifier(object):
         self.model = models
         self.ensemble = True
 
+    def end_profiling(self):
+        """
+        ends profiling of all sessions and returns the profile file names (empty without profile_prefix)
+        """
+        if self.profile_prefix is None:
+            return []
+        sessions = self.model if self.ensemble else [self.model]
+        return [s.end_profiling() for s in sessions]
+
+    def session_proba(self, session, x):
+        """
+        class probabilities of one session, converted with zipmap disabled the probability output
+        is already a float tensor of shape (batch, class) and is returned as is, older models
+        output ZipMap lists of {class: prob} dicts and are converted row by row
+        """
+        input_name = session.get_inputs()[0].name
+        output = session.get_outputs()[1]
+        result = session.run([output.name], {input_name: x})[0]
+        if output.type.startswith("tensor"):
+            return result
+        return np.stack([np.array([v for _, v in sorted(d.items())]) for d in result])
+
     def predict_proba(self, x):
         """
         predicts the probability of each class
         x: a np.array with shape (batch, features)
         return: a np.array with shape (batch, class prob)
         """
-        x = x.astype(np.float32)
+        x = np.ascontiguousarray(x, dtype=np.float32)
         if self.ensemble:
-            results = []
-            for m in self.model:
-                input_name = m.get_inputs()[0].name
-                r = m.run(None, {input_name: x})[1]
-                r = [np.array([v for _, v in sorted(d.items())]) for d in r]
-                r = np.stack(r)
-                results.append(r)
-            results = np.array(results)
+            results = np.array([self.session_proba(m, x) for m in self.model])
             res = results.mean(axis=0)
         else:
-            input_name = self.model.get_inputs()[0].name
-            result_dict = self.model.run(None, {input_name: x})[1]
-            res = [np.array([v for _, v in sorted(d.items())]) for d in result_dict]
-            res = np.stack(res)
-        return res
\ No newline at end of file
+            res = self.session_proba(self.model, x)
+        return res
@@ -1,4 +1,6 @@
 import argparse
+import csv
+import os
 import joblib
 from collections import defaultdict
 
@@ -23,60 +25,99 @@ models = [
     'XgboostEnsemble',
 ]
 
-def main(args):
-    
-    # general inputs
-    # output
-    reclassify_as_signal_file=args.reclassify_as_signal_file
-    reclassify_as_noise_file=args.reclassify_as_noise_file
+# options that are file or folder paths, resolved against the caller's working directory by the server
+path_options = [
+    'input_csv',
+    'input_fix_prob_csv',
+    'trained_folder',
+    'output_folder',
+    'reclassify_as_signal_file',
+    'reclassify_as_noise_file',
+    'manifest',
+    'optimized_model_dir',
+    'profile_prefix',
+]
 
-    # decision threshold for every rclean model
-    threshold = 0.5
-    
-    feature_file_path=args.input_csv
-    
-    not_use_fix=args.not_use_fix
-        
-    trained_folder=args.trained_folder
-    output_folder=args.output_folder
-    
-    model_names=args.model.split("@")
-    voting_threshold=int(args.voting_threshold)
-    
-    assert voting_threshold<=len(model_names), "the voting threshold must be smaller than or equal to the number of models to use"
-    
+# manifest columns, one row per fMRI run
+manifest_columns = [
+    'input_csv',
+    'input_fix_prob_csv',
+    'output_folder',
+    'reclassify_as_signal_file',
+    'reclassify_as_noise_file',
+]
+
+def load_models(args):
+    """
+    loads the onnx models named in args.model (separated by @) from args.trained_folder
+    return: dict of model name to OnnxClassifier
+    """
     models_to_use={}
-    for model_name in model_names:
+    for model_name in args.model.split("@"):
         if model_name not in models:
             raise ValueError(f"{model_name} is not supported!")
         # models_to_use[model_name]=joblib.load(f'{trained_folder}/{model_name}.joblib')
-        models_to_use[model_name]=OnnxClassifier(f'{trained_folder}/{model_name}.onnx')
-
-
-    # load csv and remove the Row column
+        models_to_use[model_name]=OnnxClassifier(f'{args.trained_folder}/{model_name}.onnx',
+                                                 intra_op_num_threads=args.intra_op_threads,
+                                                 inter_op_num_threads=args.inter_op_threads,
+                                                 graph_optimization_level=args.graph_optimization,
+                                                 execution_mode=args.execution_mode,
+                                                 optimized_model_dir=args.optimized_model_dir,
+                                                 profile_prefix=f"{args.profile_prefix}_{model_name}" if args.profile_prefix else None)
+    return models_to_use
+
+def read_features(feature_file_path):
+    """
+    loads a reclean feature csv and moves the Row column to the index
+    """
     df_feature=pd.read_csv(feature_file_path)
     df_feature.index=df_feature['Row']
     df_feature=df_feature.drop(columns=['Row'])
-    
-    predictions_dict={}
-    for model_name in model_names:
+    return df_feature
+
+def predict_runs(models_to_use, df_features):
+    """
+    signal probability of every model for the components of several runs, the runs are
+    stacked so every model predicts them in one batch
+    df_features: list of feature dataframes, one per run
+    return: list of prediction dataframes (one column per model), one per run
+    """
+    lengths=[len(df) for df in df_features]
+    features=np.concatenate([df.values for df in df_features])
 
-        predictions = models_to_use[model_name].predict_proba(df_feature.values)
+    predictions_dict={}
+    for model_name, model in models_to_use.items():
+        predictions = model.predict_proba(features)
         predictions_dict[model_name]=predictions[:,1] # signal prediction
-    
-    # save predictions
-    df_prediction=pd.DataFrame.from_dict(predictions_dict)
-    df_prediction.index=df_feature.index    
-    
-    df_predict_class = df_prediction.applymap(lambda x: 1 if x >= threshold else 0)
+
+    df_predictions=[]
+    offsets=np.cumsum([0]+lengths)
+    for df_feature, begin, end in zip(df_features, offsets[:-1], offsets[1:]):
+        df_prediction=pd.DataFrame.from_dict({name: p[begin:end] for name, p in predictions_dict.items()})
+        df_prediction.index=df_feature.index
+        df_predictions.append(df_prediction)
+    return df_predictions
+
+def write_run(df_prediction, run, args):
+    """
+    votes on the reclassifications of one run and writes its reclassify text files and probability csv
+    df_prediction: signal probability of every model, as returned by predict_runs
+    run: dict with the manifest columns of the run
+    """
+    # decision threshold for every rclean model
+    threshold = 0.5
+
+    not_use_fix=args.not_use_fix
+    voting_threshold=int(args.voting_threshold)
+
+    df_predict_class = (df_prediction >= threshold).astype(int)
 
     if not_use_fix is False: # if using FIX result
-        fix_prob_file_path=args.input_fix_prob_csv
         fix_prob_threshold=int(args.fix_prob_threshold)/100
-        df_fix_prob=pd.read_csv(fix_prob_file_path)
+        df_fix_prob=pd.read_csv(run['input_fix_prob_csv'])
         df_fix_prob.index=df_fix_prob['Row']
         df_fix_prob=df_fix_prob.drop(columns=['Row'])
-        df_fix_class = df_fix_prob.applymap(lambda x: 1 if x >= fix_prob_threshold else 0)
+        df_fix_class = (df_fix_prob >= fix_prob_threshold).astype(int)
 
     reclassify_dict={}
     for column in df_predict_class.columns:
@@ -118,19 +159,69 @@ def main(args):
     all_reclassify_to_signal_final = [num for num, count in reclassify_to_signal_count.items() if count >= cnt]
     all_reclassify_to_noise_final = [num for num, count in reclassify_to_noise_count.items() if count >= cnt]
 
-    with open(reclassify_as_signal_file, "w") as text_file:
+    with open(run['reclassify_as_signal_file'], "w") as text_file:
         text_file.write(" ".join([f"{idx+1}" for idx in sorted(all_reclassify_to_signal_final)])) # plus 1 for indexing from 1 instead of 0
         
-    with open(reclassify_as_noise_file, "w") as text_file:
+    with open(run['reclassify_as_noise_file'], "w") as text_file:
         text_file.write(" ".join([f"{idx+1}" for idx in sorted(all_reclassify_to_noise_final)]))
     
+    output_folder=run['output_folder']
     if not_use_fix is False: # if using FIX result
         df_prediction["FIX"]=df_fix_prob['Var1']
         df_prediction.to_csv(f"{output_folder}/rclean_fix_prediction_proba.csv")
     else:
         df_prediction.to_csv(f"{output_folder}/rclean_prediction_proba.csv")
+
+def read_manifest(manifest_file):
+    """
+    loads a tab separated manifest with a header of the manifest columns and one row per run,
+    input_fix_prob_csv may be empty with --not_use_fix
+    """
+    with open(manifest_file, newline="") as f:
+        runs=list(csv.DictReader(f, delimiter="\t"))
+    for column in manifest_columns:
+        if runs and column not in runs[0]:
+            raise ValueError(f"manifest {manifest_file} has no {column} column")
+    return runs
+
+def main(args, models_to_use=None, cwd=None):
+    """
+    models_to_use: models already loaded by load_models(args), e.g. kept resident by RecleanInferenceServer.py
+    cwd: folder relative paths in the manifest are relative to, default the working directory
+    """
+    model_names=args.model.split("@")
+    voting_threshold=int(args.voting_threshold)
     
-if __name__ == "__main__":
+    assert voting_threshold<=len(model_names), "the voting threshold must be smaller than or equal to the number of models to use"
+
+    # one run from the command line, or every run of a manifest with the models loaded once
+    if args.manifest is not None:
+        runs=read_manifest(args.manifest)
+    else:
+        runs=[{column: getattr(args, column) for column in manifest_columns}]
+    if cwd is not None:
+        runs=[{column: os.path.join(cwd, value) if value else value for column, value in run.items()} for run in runs]
+
+    if models_to_use is None:
+        models_to_use=load_models(args)
+
+    # stack runs up to batch_size components at a time
+    batch=[]
+    for i, run in enumerate(runs):
+        batch.append((run, read_features(run['input_csv'])))
+        if i+1 < len(runs) and sum(len(df) for _, df in batch) < args.batch_size:
+            continue
+        df_predictions=predict_runs(models_to_use, [df for _, df in batch])
+        for (run_, _), df_prediction in zip(batch, df_predictions):
+            write_run(df_prediction, run_, args)
+        batch=[]
+
+    for model_name, model in models_to_use.items():
+        for profile_file in model.end_profiling():
+            print(f"{model_name} profile: {profile_file}")
+    
+def get_parser():
+
     parser = argparse.ArgumentParser(description="Reclean classifier inference stage only.")
 
     parser.add_argument("--input_csv", type=str, help="the reclean feature csv file path")
@@ -143,6 +234,18 @@ if __name__ == "__main__":
     parser.add_argument("--voting_threshold", type=str, help="a number smaller or equal to the number of models")
     parser.add_argument("--reclassify_as_signal_file", type=str, help="output txt file from reclassification for signal")
     parser.add_argument("--reclassify_as_noise_file", type=str, help="output txt file from reclassification for noise")
+    # batch mode
+    parser.add_argument("--manifest", type=str, default=None, help="tab separated file with one run per row, replaces the per-run options: a header of " + ", ".join(manifest_columns))
+    parser.add_argument("--batch_size", type=int, default=20000, help="number of components (rows) stacked into one inference batch with --manifest, default 20000")
+    # onnxruntime tuning
+    parser.add_argument("--intra_op_threads", type=int, default=None, help="threads used inside an operator, default all cores, e.g. 1 when running many jobs per node")
+    parser.add_argument("--inter_op_threads", type=int, default=None, help="threads used across operators with the parallel execution mode")
+    parser.add_argument("--graph_optimization", type=str, default="all", choices=["disable", "basic", "extended", "all"], help="onnxruntime graph optimization level, default all")
+    parser.add_argument("--execution_mode", type=str, default="sequential", choices=["sequential", "parallel"], help="onnxruntime execution mode, default sequential")
+    parser.add_argument("--optimized_model_dir", type=str, default=None, help="folder to keep optimized models in, so later runs skip graph optimization")
+    parser.add_argument("--profile_prefix", type=str, default=None, help="write onnxruntime per-node profiling json files with this prefix")
+    return parser
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    args = get_parser().parse_args()
     main(args)
\ No newline at end of file
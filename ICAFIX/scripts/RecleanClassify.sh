@@ -40,6 +40,8 @@ opts_AddOptional '--python-interpreter' 'PythonInterpreter' 'string' "the python
 opts_AddOptional '--model-folder' 'ModelFolder' 'string' "the folder path of the trained models" "$HCPPIPEDIR/ICAFIX/rclean_models"
 opts_AddOptional '--model-to-use' 'ModelToUse' 'string' "the models to use separated by '@'" "RandomForest@MLP"
 opts_AddOptional '--vote-threshold' 'VoteThresh' 'integer' "a decision threshold for determing reclassifications, should be less than to equal to the number of models to use" ""
+opts_AddOptional '--inference-socket' 'InferenceSocket' 'path' "unix socket of a running RecleanInferenceServer.py that keeps the models loaded, inference runs in-process when no server answers there" ""
+opts_AddOptional '--onnx-threads' 'OnnxThreads' 'integer' "threads per onnxruntime inference session, default all cores, use 1 when running many subjects per node" ""
 
 opts_AddOptional '--matlab-run-mode' 'MatlabMode' '0, 1, or 2' "defaults to $g_matlab_default_mode
 
@@ -232,7 +234,11 @@ esac
 # hardcoded
 FixProbThresh="10"
 
-# inference each subjects under python environment
+# inference of all runs in one python process, the models are loaded once and the runs are batched together
+# under the subject's Results, like every other input, so it is visible inside the python singularity
+ManifestName="$(mktemp "${StudyFolder}/${Subject}/MNINonLinear/Results/RecleanManifest_XXXXXX")"
+tempfiles_add "$ManifestName"
+printf 'input_csv\tinput_fix_prob_csv\toutput_folder\treclassify_as_signal_file\treclassify_as_noise_file\n' > "$ManifestName"
 for fMRIName in "${fMRINamesToUse[@]}" ; do
     RecleanFeaturePath="${StudyFolder}/${Subject}/MNINonLinear/Results/${fMRIName}/${fMRIName}_hp${HighPass}.ica/fix_reclean_features.csv"
     FixProbPath="${StudyFolder}/${Subject}/MNINonLinear/Results/${fMRIName}/${fMRIName}_hp${HighPass}.ica/fix_prob.csv"
@@ -247,28 +253,33 @@ for fMRIName in "${fMRINamesToUse[@]}" ; do
     ReclassifyAsSignalTxt="${StudyFolder}/${Subject}/MNINonLinear/Results/${fMRIName}/${ReclassifyAsSignalFile}"
     ReclassifyAsNoiseTxt="${StudyFolder}/${Subject}/MNINonLinear/Results/${fMRIName}/${ReclassifyAsNoiseFile}"
 
-    pythonCode=(
-        "$HCPPIPEDIR/ICAFIX/scripts/RecleanClassifierInference.py"
-        --input_csv="$RecleanFeaturePath"
-        --input_fix_prob_csv="$FixProbPath"
-        --fix_prob_threshold="$FixProbThresh"
-        --trained_folder="$ModelFolder"
-        --model="$ModelToUse"
-        --output_folder="$PredictionResult"
-        --voting_threshold="$VoteThresh"
-        --reclassify_as_signal_file="$ReclassifyAsSignalTxt"
-        --reclassify_as_noise_file="$ReclassifyAsNoiseTxt"
-    )
-
-    if [ "$UseLocalPython" = "FALSE" ]; then
-        # use singularity
-        PythonLaunchCommand=("${singularity_command[@]}" "${pythonCode[@]}")
-    else
-        # use native env
-        PythonLaunchCommand=("${PythonInterpreter}" "${pythonCode[@]}")
-    fi
-
-    log_Msg "Run python inference..."
-    log_Msg "${PythonLaunchCommand[@]}"
-    "${PythonLaunchCommand[@]}"
+    printf '%s\t%s\t%s\t%s\t%s\n' "$RecleanFeaturePath" "$FixProbPath" "$PredictionResult" "$ReclassifyAsSignalTxt" "$ReclassifyAsNoiseTxt" >> "$ManifestName"
 done
+
+pythonCode=(
+    "$HCPPIPEDIR/ICAFIX/scripts/RecleanClassifierInference.py"
+    --manifest="$ManifestName"
+    --fix_prob_threshold="$FixProbThresh"
+    --trained_folder="$ModelFolder"
+    --model="$ModelToUse"
+    --voting_threshold="$VoteThresh"
+)
+if [[ "$OnnxThreads" != "" ]]; then
+    pythonCode+=(--intra_op_threads="$OnnxThreads" --inter_op_threads=1)
+fi
+if [[ "$InferenceSocket" != "" ]]; then
+    # same options through the thin client, which falls back to RecleanClassifierInference.py in-process
+    pythonCode=("$HCPPIPEDIR/ICAFIX/scripts/RecleanInferenceClient.py" --socket="$InferenceSocket" "${pythonCode[@]:1}")
+fi
+
+if [ "$UseLocalPython" = "FALSE" ]; then
+    # use singularity
+    PythonLaunchCommand=("${singularity_command[@]}" "${pythonCode[@]}")
+else
+    # use native env
+    PythonLaunchCommand=("${PythonInterpreter}" "${pythonCode[@]}")
+fi
+
+log_Msg "Run python inference..."
+log_Msg "${PythonLaunchCommand[@]}"
+"${PythonLaunchCommand[@]}"
@@ -0,0 +1,72 @@
+import json
+import os
+import socket
+import sys
+
+# thin client, only the standard library is imported unless the inference runs in this process
+
+def usage():
+
+    print(f"usage: {sys.argv[0]} --socket=PATH [RecleanClassifierInference.py options]\n"
+          "runs the inference on the RecleanInferenceServer.py listening on PATH, or in this process if no server answers there",
+          file=sys.stderr)
+    sys.exit(2)
+
+def split_socket(argv):
+    """
+    separates the --socket option from the RecleanClassifierInference.py options
+    """
+    socket_path, rest = None, []
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith("--socket="):
+            socket_path = argv[i][len("--socket="):]
+        elif argv[i] == "--socket" and i + 1 < len(argv):
+            socket_path = argv[i + 1]
+            i += 1
+        else:
+            rest.append(argv[i])
+        i += 1
+    return socket_path, rest
+
+def request(socket_path, argv):
+    """
+    sends the inference options to the server
+    return: the reply dict, None if no server is listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return None
+        client.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode())
+        with client.makefile("rb") as f:
+            reply = f.readline()
+    finally:
+        client.close()
+    # the server went away before answering
+    if not reply:
+        return None
+    return json.loads(reply)
+
+def run_in_process(argv):
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import RecleanClassifierInference as inference
+    inference.main(inference.get_parser().parse_args(argv))
+
+if __name__ == "__main__":
+    socket_path, argv = split_socket(sys.argv[1:])
+    if socket_path is None:
+        usage()
+
+    reply = request(socket_path, argv)
+    if reply is None:
+        print(f"no inference server on {socket_path}, running in-process", file=sys.stderr)
+        run_in_process(argv)
+    elif reply["status"] == "unsupported":
+        print(f"{reply['message']}, running in-process", file=sys.stderr)
+        run_in_process(argv)
+    elif reply["status"] != "ok":
+        sys.exit(f"inference server failed:\n{reply['message']}")
@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+import RecleanClassifierInference as inference
+
+# models kept loaded between requests, keyed by model folder, model names and onnxruntime settings
+resident_models = {}
+resident_lock = threading.Lock()
+
+def model_key(args):
+
+    return (
+        os.path.abspath(args.trained_folder),
+        args.model,
+        args.intra_op_threads,
+        args.inter_op_threads,
+        args.graph_optimization,
+        args.execution_mode,
+        args.optimized_model_dir and os.path.abspath(args.optimized_model_dir),
+    )
+
+def get_models(args):
+    """
+    the models for the request, loaded on first use and kept for the following requests
+    """
+    key = model_key(args)
+    with resident_lock:
+        if key not in resident_models:
+            print(f"loading {args.model} from {args.trained_folder}", flush=True)
+            resident_models[key] = inference.load_models(args)
+        return resident_models[key]
+
+def run_request(request):
+    """
+    runs RecleanClassifierInference.py with the command line arguments of the request
+    request: dict with "argv" (list of arguments) and "cwd" (working directory of the client)
+    return: reply dict with "status" ok, error or unsupported, and a "message"
+    """
+    if not isinstance(request, dict):
+        return {"status": "error", "message": "request is not a json object"}
+    argv = request.get("argv")
+    cwd = request.get("cwd")
+    if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+        return {"status": "error", "message": "request has no argv list of strings"}
+    if not isinstance(cwd, str) or not os.path.isabs(cwd):
+        return {"status": "error", "message": "request has no absolute cwd"}
+    try:
+        args = inference.get_parser().parse_args(argv)
+    except SystemExit:
+        return {"status": "error", "message": f"invalid arguments: {argv}"}
+    # profiles cover the lifetime of a session, the client runs these in-process
+    if args.profile_prefix is not None:
+        return {"status": "unsupported", "message": "profiling is not done by the server"}
+    for name in inference.path_options:
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.join(cwd, getattr(args, name)))
+
+    try:
+        inference.main(args, models_to_use=get_models(args), cwd=cwd)
+    except Exception:
+        return {"status": "error", "message": traceback.format_exc()}
+    return {"status": "ok", "message": ""}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    one json request line per connection, answered with one json reply line
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            request = None
+            reply = {"status": "error", "message": "request is not json"}
+        else:
+            reply = run_request(request)
+        argv = request.get("argv") if isinstance(request, dict) else None
+        print(f"{reply['status']}: {argv}", flush=True)
+        self.wfile.write((json.dumps(reply) + "\n").encode())
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def remove_stale_socket(socket_path):
+    """
+    removes the socket file left by a server that is gone, fails if a server still answers on it
+    """
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.remove(socket_path)
+    else:
+        sys.exit(f"a server is already running on {socket_path}")
+    finally:
+        probe.close()
+
+def main(args, preload):
+
+    remove_stale_socket(args.socket)
+    if preload.model is not None:
+        get_models(preload)
+
+    # only the user running the server can connect
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(args.socket, RequestHandler)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"serving on {args.socket}", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keeps the reclean classifier models loaded and runs RecleanClassifierInference.py for RecleanInferenceClient.py over a unix socket. "
+                                     "Any other options (e.g. --trained_folder, --model, --intra_op_threads) load those models at startup instead of on the first request.")
+    parser.add_argument("--socket", type=str, required=True, help="unix socket path to listen on")
+
+    args, rest = parser.parse_known_args()
+    main(args, inference.get_parser().parse_args(rest))
@@ -1,5 +1,6 @@
 import argparse
 import joblib
+import os
 from collections import defaultdict
 
 import numpy as np
@@ -23,6 +24,8 @@ from skl2onnx.convert import may_switch_bases_classes_order
 from onnxmltools.convert.xgboost.operator_converters.XGBoost import convert_xgboost
 from onnxmltools.convert import convert_xgboost as convert_xgboost_booster
 import onnxruntime as ort
+import onnx
+from onnx import helper, numpy_helper
 
 from OnnxClassifierInterface import OnnxClassifier
 
@@ -53,6 +56,97 @@ update_registered_converter(
     options={"nocl": [True, False], "zipmap": [True, False, "columns"]},
 )
 
+def converter_options(model, zipmap):
+    """
+    converter options for a classifier or a pipeline ending in one, without zipmap the
+    probabilities are output as a float tensor (batch, class) instead of a list of dicts
+    """
+    if zipmap:
+        return None
+    classifier = model.steps[-1][1] if hasattr(model, "steps") else model
+    return {id(classifier): {"zipmap": False}}
+
+def convert_member(model, in_dim, zipmap):
+    """
+    onnx model of one XGBClassifier member of an XgboostEnsemble
+    """
+    with may_switch_bases_classes_order(XGBClassifier):
+        return convert_sklearn(
+            model,
+            "pipeline_xgboost",
+            initial_types=[("input", FloatTensorType([None, in_dim]))],
+            target_opset={"": 12, "ai.onnx.ml": 2},
+            options=converter_options(model, zipmap),
+        )
+
+def fuse_ensemble(onnx_models):
+    """
+    fuses the onnx models of the ensemble members into one model: the trees of every member
+    run in one graph and their class probabilities are averaged inside it, with the same
+    input and outputs (label and ZipMap or tensor probabilities) as a single member model
+    onnx_models: list of onnx ModelProto converted from the XGBClassifier members
+    """
+    first = onnx_models[0].graph
+    input_name = first.input[0].name
+    nodes, initializers, member_probs = [], [], []
+    for idx, model in enumerate(onnx_models):
+        graph = model.graph
+        assert graph.input[0] == first.input[0], "ensemble members must share the same input"
+        zipmap = next((n for n in graph.node if n.op_type == "ZipMap"), None)
+        probs = zipmap.input[0] if zipmap is not None else graph.output[1].name
+        classes = next(helper.get_attribute_value(a) for n in graph.node for a in n.attribute if a.name == "classlabels_int64s")
+
+        # keep the nodes computing the probability tensor, prefixing names so members don't collide
+        needed = {probs}
+        keep = []
+        for node in reversed(graph.node):
+            if any(o in needed for o in node.output):
+                keep.append(node)
+                needed.update(node.input)
+
+        def rename(name):
+            return name if name in ("", input_name) else f"member{idx}_{name}"
+
+        for node in reversed(keep):
+            fused = onnx.NodeProto()
+            fused.CopyFrom(node)
+            fused.name = rename(node.name or node.op_type)
+            fused.input[:] = [rename(n) for n in node.input]
+            fused.output[:] = [rename(n) for n in node.output]
+            nodes.append(fused)
+        for init in graph.initializer:
+            if init.name in needed:
+                fused = onnx.TensorProto()
+                fused.CopyFrom(init)
+                fused.name = rename(init.name)
+                initializers.append(fused)
+        member_probs.append(rename(probs))
+
+    # average, then label and probability outputs like the members
+    initializers.append(numpy_helper.from_array(np.array(classes, dtype=np.int64), "classes"))
+    nodes += [
+        helper.make_node("Mean", member_probs, ["ensemble_probabilities"], name="ensemble_mean"),
+        helper.make_node("ArgMax", ["ensemble_probabilities"], ["label_index"], name="ensemble_argmax", axis=1, keepdims=0),
+        helper.make_node("Gather", ["classes", "label_index"], [first.output[0].name], name="ensemble_label"),
+    ]
+    if zipmap is not None:
+        nodes.append(helper.make_node("ZipMap", ["ensemble_probabilities"], [first.output[1].name], name="ensemble_zipmap", domain="ai.onnx.ml", classlabels_int64s=classes))
+    else:
+        nodes.append(helper.make_node("Identity", ["ensemble_probabilities"], [first.output[1].name], name="ensemble_output_probability"))
+    graph = helper.make_graph(nodes, "xgboost_ensemble", [first.input[0]], list(first.output), initializers)
+    fused_model = helper.make_model(graph, opset_imports=onnx_models[0].opset_import, producer_name="convertJoblibToOnnxModel")
+    fused_model.ir_version = onnx_models[0].ir_version
+    onnx.checker.check_model(fused_model)
+    return fused_model
+
+def member_proba(onnx_models, x):
+    """
+    class probabilities averaged over the member models one session each, as
+    OnnxClassifier.load_model_ensemble computes them from the member files
+    """
+    classifier = OnnxClassifier()
+    return np.mean([classifier.session_proba(ort.InferenceSession(m.SerializeToString()), x) for m in onnx_models], axis=0)
+
 def main(args):
 
     # model_names = "RandomForest@MLP@Xgboost@XgboostEnsemble".split("@")
@@ -75,7 +169,8 @@ def main(args):
 
         if "xgboost" not in model_name.lower():
             initial_type = [('float_input', FloatTensorType([None, in_dim]))]
-            onx = convert_sklearn(models_to_use[model_name], initial_types=initial_type,)
+            onx = convert_sklearn(models_to_use[model_name], initial_types=initial_type,
+                                  options=converter_options(models_to_use[model_name], args.zipmap))
             with open(f"{trained_folder}/{model_name}.onnx", "wb") as f:
                 f.write(onx.SerializeToString())
 
@@ -86,30 +181,43 @@ def main(args):
                     "pipeline_xgboost",
                     initial_types=[("input", FloatTensorType([None, in_dim]))],
                     target_opset={"": 12, "ai.onnx.ml": 2},
+                    options=converter_options(models_to_use[model_name], args.zipmap),
                 )
             with open(f"{trained_folder}/{model_name}.onnx", "wb") as f:
                 f.write(onx.SerializeToString())
         else:
+            members = []
             for idx, mode_ens in enumerate(models_to_use[model_name].named_steps["xgboostensembleclassifier"].models):
-                with may_switch_bases_classes_order(XGBClassifier):
-                    onx = convert_sklearn(
-                        mode_ens,
-                        "pipeline_xgboost",
-                        initial_types=[("input", FloatTensorType([None, in_dim]))],
-                        target_opset={"": 12, "ai.onnx.ml": 2},
-                    )
-                with open(f"{trained_folder}/{model_name}_{idx}.onnx", "wb") as f:
-                    f.write(onx.SerializeToString())
+                onx = convert_member(mode_ens, in_dim, args.zipmap)
+                if args.fuse_ensemble:
+                    members.append(onx)
+                else:
+                    with open(f"{trained_folder}/{model_name}_{idx}.onnx", "wb") as f:
+                        f.write(onx.SerializeToString())
+            # OnnxClassifier prefers a fused model over the member files, so never leave a stale one
+            # the member files are loaded from _1 on, the fused graph averages the same members
+            fused_name = f"{trained_folder}/{model_name}.onnx"
+            if args.fuse_ensemble:
+                fused = fuse_ensemble(members[1:])
+                legacy = member_proba(members[1:], rndin)
+                with open(fused_name, "wb") as f:
+                    f.write(fused.SerializeToString())
+            elif os.path.exists(fused_name):
+                os.remove(fused_name)
 
         
         models_to_use2[model_name]=OnnxClassifier(f'{trained_folder}/{model_name}.onnx')
 
         results = models_to_use2[model_name].predict_proba(rndin)
         print(results)
+        if "ensemble" in model_name.lower() and args.fuse_ensemble and not np.allclose(results, legacy, rtol=0, atol=1e-6):
+            raise RuntimeError(f"fused {model_name} differs from its member files: {results} != {legacy}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Reclean classifier inference stage only.")
     parser.add_argument("--model", type=str, help="the models to use for inference e.g., 'RandomForest@Xgboost'")
     parser.add_argument("--trained_folder", type=str, help="Trained folder path")
+    parser.add_argument("--fuse_ensemble", action="store_true", help="write the XgboostEnsemble members as one fused model (XgboostEnsemble.onnx) instead of one file per member")
+    parser.add_argument("--no_zipmap", dest="zipmap", action="store_false", help="output the class probabilities as a float tensor instead of a list of dicts (ZipMap), faster to read in OnnxClassifier")
     main(parser.parse_args())
     
\ No newline at end of file
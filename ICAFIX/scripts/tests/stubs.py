@@ -0,0 +1,58 @@
+"""
+Stand-ins for the onnx models and the feature files in the inference tests
+"""
+
+import numpy as np
+import pandas as pd
+
+MODELS = "Xgboost@MLP@RandomForest"
+
+
+class StubModel:
+    """
+    deterministic signal probabilities from the features, in place of an OnnxClassifier,
+    every row on its own like the tree models, so stacking runs cannot change the values
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.batches = []
+
+    def predict_proba(self, x):
+        self.batches.append(len(x))
+        signal = 1 / (1 + np.exp(-(x * self.weights).sum(axis=1)))
+        return np.stack((1 - signal, signal), axis=1)
+
+    def end_profiling(self):
+        return []
+
+
+def stub_models():
+    rng = np.random.default_rng(0)
+    return {name: StubModel(rng.normal(size=8)) for name in MODELS.split("@")}
+
+
+def write_runs(folder, sizes):
+    """
+    synthetic feature and FIX probability csv files of runs with the given numbers of components
+    return: the manifest columns of every run
+    """
+    rng = np.random.default_rng(1)
+    runs = []
+    for i, size in enumerate(sizes):
+        run_folder = folder / f"run{i}"
+        run_folder.mkdir()
+        features = pd.DataFrame(rng.normal(size=(size, 8)), columns=[f"f{j}" for j in range(8)])
+        features.insert(0, "Row", np.arange(1, size + 1))
+        features.to_csv(run_folder / "features.csv", index=False)
+        pd.DataFrame({"Row": np.arange(1, size + 1), "Var1": rng.random(size)}).to_csv(run_folder / "fix_prob.csv", index=False)
+        runs.append(
+            {
+                "input_csv": str(run_folder / "features.csv"),
+                "input_fix_prob_csv": str(run_folder / "fix_prob.csv"),
+                "output_folder": str(run_folder),
+                "reclassify_as_signal_file": str(run_folder / "signal.txt"),
+                "reclassify_as_noise_file": str(run_folder / "noise.txt"),
+            }
+        )
+    return runs
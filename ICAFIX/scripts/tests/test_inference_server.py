@@ -0,0 +1,115 @@
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+pytest.importorskip("xgboost")
+
+import RecleanClassifierInference as inference
+import RecleanInferenceClient as client
+import RecleanInferenceServer as server
+from stubs import MODELS, stub_models, write_runs
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    # unix socket paths are limited to about 100 characters
+    return str(tmp_path / "s")
+
+
+@pytest.fixture
+def running_server(socket_path, monkeypatch):
+    monkeypatch.setattr(server, "resident_models", {})
+    monkeypatch.setattr(inference, "load_models", lambda args: stub_models())
+    instance = server.Server(socket_path, server.RequestHandler)
+    thread = threading.Thread(target=instance.serve_forever, daemon=True)
+    thread.start()
+    yield instance
+    instance.shutdown()
+    instance.server_close()
+    thread.join()
+
+
+def run_argv(run):
+    argv = ["--model", MODELS, "--voting_threshold", "2", "--not_use_fix", "--trained_folder", "models"]
+    return argv + [f"--{column}={value}" for column, value in run.items() if column != "input_fix_prob_csv"]
+
+
+def relative(run, folder):
+    return {column: os.path.relpath(value, folder) for column, value in run.items()}
+
+
+def raw_request(socket_path, line):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(line)
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def test_server_matches_in_process(tmp_path, running_server, socket_path, monkeypatch):
+    for folder in ("served", "local"):
+        (tmp_path / folder).mkdir()
+    served = write_runs(tmp_path / "served", [20, 7])
+    local = write_runs(tmp_path / "local", [20, 7])
+
+    # relative paths are resolved against the client's working directory
+    monkeypatch.chdir(tmp_path / "served")
+    for run in served:
+        assert client.request(socket_path, run_argv(relative(run, tmp_path / "served"))) == {"status": "ok", "message": ""}
+    # the models are loaded once and kept for the next requests
+    assert len(server.resident_models) == 1
+
+    monkeypatch.chdir(tmp_path / "local")
+    for run in local:
+        client.run_in_process(run_argv(relative(run, tmp_path / "local")))
+
+    for a, b in zip(served, local):
+        for name in ("reclassify_as_signal_file", "reclassify_as_noise_file"):
+            assert open(a[name]).read() == open(b[name]).read()
+        assert open(os.path.join(a["output_folder"], "rclean_prediction_proba.csv")).read() == open(
+            os.path.join(b["output_folder"], "rclean_prediction_proba.csv")
+        ).read()
+
+
+def test_no_server_falls_back(tmp_path, socket_path, monkeypatch):
+    assert client.request(socket_path, ["--model", MODELS]) is None
+    # a socket file left behind by a server that is gone is removed
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert client.request(socket_path, ["--model", MODELS]) is None
+    server.remove_stale_socket(socket_path)
+    assert not os.path.exists(socket_path)
+
+
+def test_profiling_is_unsupported(running_server, socket_path, tmp_path):
+    reply = client.request(socket_path, ["--model", MODELS, "--profile_prefix", "prof"])
+    assert reply["status"] == "unsupported"
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        b"not json\n",
+        b"[1, 2]\n",
+        b'{"argv": ["--model", "Xgboost"]}\n',
+        b'{"argv": ["--model", "Xgboost"], "cwd": "relative"}\n',
+        b'{"argv": "--model Xgboost", "cwd": "/tmp"}\n',
+        b'{"cwd": "/tmp"}\n',
+        b'{"argv": ["--no_such_option"], "cwd": "/tmp"}\n',
+    ],
+)
+def test_malformed_requests_get_error_replies(running_server, socket_path, line):
+    assert raw_request(socket_path, line)["status"] == "error"
+    # the server keeps answering
+    assert raw_request(socket_path, b"[]\n")["status"] == "error"
+
+
+def test_failed_inference_is_reported(running_server, socket_path, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    reply = client.request(socket_path, run_argv({"input_csv": "missing.csv", "output_folder": ".", "reclassify_as_signal_file": "s.txt", "reclassify_as_noise_file": "n.txt"}))
+    assert reply["status"] == "error"
+    assert "missing.csv" in reply["message"]
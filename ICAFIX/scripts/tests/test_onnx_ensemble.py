@@ -0,0 +1,77 @@
+import numpy as np
+import onnxruntime as ort
+import pytest
+
+pytest.importorskip("onnxmltools")
+xgboost = pytest.importorskip("xgboost")
+
+import convertJoblibToOnnxModel as converter
+from OnnxClassifierInterface import OnnxClassifier
+
+NFEATURES = 20
+
+
+@pytest.fixture(scope="module")
+def members():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(400, NFEATURES)).astype(np.float32)
+    y = (x[:, 0] + 0.5 * x[:, 1] ** 2 + 0.3 * rng.normal(size=400) > 0.5).astype(int)
+    return [
+        xgboost.XGBClassifier(n_estimators=20, max_depth=3, subsample=0.7, random_state=seed).fit(x, y)
+        for seed in range(4)
+    ]
+
+
+@pytest.fixture
+def features():
+    return np.random.default_rng(1).normal(size=(50, NFEATURES)).astype(np.float32)
+
+
+def write_members(folder, onnx_models):
+    for idx, onx in enumerate(onnx_models):
+        (folder / f"XgboostEnsemble_{idx}.onnx").write_bytes(onx.SerializeToString())
+
+
+@pytest.mark.parametrize("zipmap", [True, False])
+def test_fused_matches_member_files(tmp_path, members, features, zipmap):
+    onnx_models = [converter.convert_member(m, NFEATURES, zipmap) for m in members]
+    write_members(tmp_path, onnx_models)
+    model_name = str(tmp_path / "XgboostEnsemble.onnx")
+    legacy = OnnxClassifier(model_name)
+    assert legacy.ensemble and len(legacy.model) == len(members) - 1
+
+    # the member files are read from _1 on, the fused graph averages the same members
+    (tmp_path / "XgboostEnsemble.onnx").write_bytes(converter.fuse_ensemble(onnx_models[1:]).SerializeToString())
+    fused = OnnxClassifier(model_name)
+    assert not fused.ensemble
+
+    expected = legacy.predict_proba(features)
+    np.testing.assert_allclose(fused.predict_proba(features), expected, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(converter.member_proba(onnx_models[1:], features), expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("zipmap", [True, False])
+def test_fused_outputs(members, features, zipmap):
+    onnx_models = [converter.convert_member(m, NFEATURES, zipmap) for m in members]
+    fused = converter.fuse_ensemble(onnx_models)
+    session = ort.InferenceSession(fused.SerializeToString())
+    outputs = session.get_outputs()
+    # the same outputs as a member: label, then ZipMap or tensor probabilities
+    assert [o.name for o in outputs] == [o.name for o in onnx_models[0].graph.output]
+    assert outputs[1].type.startswith("tensor") != zipmap
+
+    label, _ = session.run(None, {session.get_inputs()[0].name: features})
+    proba = OnnxClassifier().session_proba(session, features)
+    np.testing.assert_array_equal(label, np.argmax(proba, axis=1))
+    np.testing.assert_allclose(proba, np.mean([m.predict_proba(features) for m in members], axis=0), rtol=0, atol=1e-5)
+
+
+def test_zipmap_and_tensor_agree(members, features):
+    sessions = {}
+    for zipmap in (True, False):
+        onnx_models = [converter.convert_member(m, NFEATURES, zipmap) for m in members]
+        sessions[zipmap] = ort.InferenceSession(converter.fuse_ensemble(onnx_models).SerializeToString())
+    classifier = OnnxClassifier()
+    np.testing.assert_array_equal(
+        classifier.session_proba(sessions[True], features), classifier.session_proba(sessions[False], features)
+    )
@@ -0,0 +1,69 @@
+import filecmp
+import os
+
+import pytest
+
+pytest.importorskip("xgboost")
+
+import RecleanClassifierInference as inference
+from stubs import MODELS, stub_models, write_runs
+
+
+def common_options(not_use_fix):
+    options = ["--model", MODELS, "--voting_threshold", "2", "--fix_prob_threshold", "10", "--trained_folder", "unused"]
+    return options + (["--not_use_fix"] if not_use_fix else [])
+
+
+def outputs(run, not_use_fix):
+    csv_name = "rclean_prediction_proba.csv" if not_use_fix else "rclean_fix_prediction_proba.csv"
+    return [run["reclassify_as_signal_file"], run["reclassify_as_noise_file"], os.path.join(run["output_folder"], csv_name)]
+
+
+@pytest.mark.parametrize("not_use_fix", [False, True])
+@pytest.mark.parametrize("batch_size", [20000, 40, 1])
+def test_manifest_matches_per_run(tmp_path, not_use_fix, batch_size):
+    runs = write_runs(tmp_path, [30, 17, 45, 5])
+    parser = inference.get_parser()
+
+    expected = []
+    for run in runs:
+        argv = common_options(not_use_fix) + [f"--{column}={value}" for column, value in run.items()]
+        inference.main(parser.parse_args(argv), models_to_use=stub_models())
+        for filename in outputs(run, not_use_fix):
+            os.replace(filename, filename + ".per_run")
+            expected.append(filename)
+
+    manifest = tmp_path / "manifest.tsv"
+    lines = ["\t".join(inference.manifest_columns)]
+    lines += ["\t".join("" if not_use_fix and c == "input_fix_prob_csv" else run[c] for c in inference.manifest_columns) for run in runs]
+    manifest.write_text("\n".join(lines) + "\n")
+    models = stub_models()
+    argv = common_options(not_use_fix) + ["--manifest", str(manifest), "--batch_size", str(batch_size)]
+    inference.main(parser.parse_args(argv), models_to_use=models)
+
+    for filename in expected:
+        assert filecmp.cmp(filename, filename + ".per_run", shallow=False), filename
+    # runs are stacked up to batch_size components, and never split
+    batches = models["Xgboost"].batches
+    assert sum(batches) == 97
+    assert len(batches) == {20000: 1, 40: 3, 1: 4}[batch_size]
+
+
+def test_manifest_paths_relative_to_cwd(tmp_path):
+    runs = write_runs(tmp_path, [12, 9])
+    relative = [{c: os.path.relpath(v, tmp_path) for c, v in run.items()} for run in runs]
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text(
+        "\n".join(["\t".join(inference.manifest_columns)] + ["\t".join(run[c] for c in inference.manifest_columns) for run in relative]) + "\n"
+    )
+    args = inference.get_parser().parse_args(common_options(False) + ["--manifest", str(manifest)])
+    inference.main(args, models_to_use=stub_models(), cwd=str(tmp_path))
+    for run in runs:
+        assert all(os.path.exists(f) for f in outputs(run, False))
+
+
+def test_manifest_missing_column(tmp_path):
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text("input_csv\toutput_folder\na.csv\tout\n")
+    with pytest.raises(ValueError, match="input_fix_prob_csv"):
+        inference.read_manifest(str(manifest))
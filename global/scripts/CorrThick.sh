@@ -27,9 +27,18 @@ opts_AddMandatory '--subject' 'Subject' 'subject ID' "subject-id"
 opts_AddOptional '--regnames' 'RegNamesStr' 'my reg str' "set the desired registration name(s) separated by @, 'string' 'RegName@RegName@RegName@...etc.' default MSMSulc" "MSMSulc"
 opts_AddOptional '--hemi' 'Hemi' 'hemisphere' "provide hemisphere for regression calculation, L=Left, R=Right, or B=Both, default 'B'" "B"
 opts_AddOptional '--surf' 'Surface' 'surface' "provide surface for regression calculation, white or midthickness, default midthickness" "midthickness"
-opts_AddOptional '--patch-size' 'PatchSize' 'distance' "provide patch kernel size in millimeters FWHM for regression, default 6" "6"
+opts_AddOptional '--patch-size' 'PatchSize' 'distance' "provide patch kernel size in millimeters FWHM for regression, default 6.  Several sizes separated by @, e.g. '4@6@8', are computed in one sweep that shares the geodesic distances, with outputs named MRcorrThickness_patch<size> etc." "6"
 opts_AddOptional '--surf-smooth' 'SurfSmooth' 'distance' "provide surface smoothing in millimeters FWHM, default 2.14" "2.14"
 opts_AddOptional '--metric-smooth' 'MetricSmooth' 'distance' "provide metric smoothing in millimeters FWHM, default 2.52" "2.52"
+opts_AddOptional '--cache-dir' 'CacheDir' 'path' "shared folder to cache intermediates that are identical across subjects and runs (e.g. the 164k_fs_LR mesh topology, and geodesic patches of reruns with the same surface and patch size), default no caching" ""
+opts_AddOptional '--cache-size' 'CacheSize' 'gigabytes' "maximum size of the --cache-dir folder, least recently used entries are removed beyond it, default 20" "20"
+opts_AddOptional '--normcoeffs' 'NormCoeffs' 'YES or NO' "whether to compute and output the MAD-normalized regression coefficients (MRcorrThickness_normcoeffs), default 'YES'" "YES"
+opts_AddOptional '--geodesic' 'Geodesic' 'wb or internal' "how to compute the geodesic regression patches, 'wb' uses wb_command -surface-geodesic-distance-sparse-text, 'internal' computes them in python without an intermediate text file, default 'wb'" "wb"
+opts_AddOptional '--smoothing' 'Smoothing' 'wb or internal' "how to smooth the surface and curvatures, 'wb' uses wb_command -metric-smoothing, 'internal' (experimental) builds each geodesic Gaussian smoothing operator once and applies it to all maps in python, its rows of Gaussian times vertex area are normalized to sum 1 unlike wb's GEO_GAUSS_AREA, so the results are close to but not equal to 'wb' and no tolerance against wb is established, default 'wb'" "wb"
+opts_AddOptional '--resampling' 'Resampling' 'wb or internal' "how to resample metrics between the native and 164k_fs_LR meshes, 'wb' uses wb_command -metric-resample ADAP_BARY_AREA, 'internal' (experimental) builds the resampling matrix once per subject and hemisphere and resamples all outputs with one sparse product, it approximates ADAP_BARY_AREA with an area correction from the current surface only instead of both -area-surfs, so the results are close to but not equal to 'wb' and no tolerance against wb is established, default 'wb'" "wb"
+opts_AddOptional '--regression-method' 'RegressionMethod' 'batched, sparse or pool' "how to solve the patch regressions, 'batched' solves all patches as stacked systems, 'sparse' forms the normal equations with sparse products (faster, but sums in a different order and agrees with 'batched' only to within 1e-3 of the largest value of each output, differences up to about 4e-4 were seen on real surfaces), 'pool' solves ranges of patches in a process pool, default 'batched'" "batched"
+opts_AddOptional '--wb-jobs' 'WbJobs' 'number' "maximum number of independent wb_command calls and python worker processes run at the same time, e.g. the curvature smoothings and resamplings, default the number of physical cores, shared by both hemispheres when they run side by side" ""
+opts_AddOptional '--keep-intermediates' 'KeepIntermediates' 'YES or NO' "whether to keep the intermediate CorrThick folder, a rerun then skips every stage whose inputs and parameters are unchanged (e.g. the geodesic patches when only --metric-smooth changes) and resumes after a failed stage, default 'NO'" "NO"
 opts_AddOptional '--skip-computation' 'SkipCompute' 'YES or NO' "whether or not to compute the curvature-corrected (folding-compensated) cortical thickness, if it is already available, but just to resample it to 164k and 32k, defaults to 'NO'" "NO"
 
 opts_ParseArguments "$@"
@@ -44,6 +53,8 @@ opts_ShowValues
 
 #sanity check boolean strings and convert to 1 and 0
 SkC=$(opts_StringToBool "$SkipCompute")
+NormC=$(opts_StringToBool "$NormCoeffs")
+KeepI=$(opts_StringToBool "$KeepIntermediates")
 
 #set paths
 NonlinearFolder="$SubjectDir"/"$Subject"/MNINonLinear
@@ -53,6 +64,52 @@ T1wNativeFolder="$SubjectDir"/"$Subject"/T1w/Native
 #Make intermediate directory to save intermediate files
 mkdir -p "$NativeFolder"/CorrThick
 
+CorrThickArgs=()
+if [[ "$CacheDir" != "" ]]
+then
+	CorrThickArgs+=(--cache-dir "$CacheDir" --cache-size "$CacheSize")
+fi
+case "$Geodesic" in
+    (wb|internal)
+        CorrThickArgs+=(--geodesic "$Geodesic")
+        ;;
+    (*)
+        log_Err_Abort "unrecognized geodesic method '$Geodesic', use wb or internal"
+        ;;
+esac
+case "$Smoothing" in
+    (wb|internal)
+        CorrThickArgs+=(--smoothing "$Smoothing")
+        ;;
+    (*)
+        log_Err_Abort "unrecognized smoothing method '$Smoothing', use wb or internal"
+        ;;
+esac
+case "$Resampling" in
+    (wb|internal)
+        CorrThickArgs+=(--resampling "$Resampling")
+        ;;
+    (*)
+        log_Err_Abort "unrecognized resampling method '$Resampling', use wb or internal"
+        ;;
+esac
+case "$RegressionMethod" in
+    (batched|sparse|pool)
+        CorrThickArgs+=(--regression-method "$RegressionMethod")
+        ;;
+    (*)
+        log_Err_Abort "unrecognized regression method '$RegressionMethod', use batched, sparse or pool"
+        ;;
+esac
+if [[ "$WbJobs" != "" ]]
+then
+	CorrThickArgs+=(--wb-jobs "$WbJobs")
+fi
+if ((! NormC))
+then
+	CorrThickArgs+=(--no-normcoeffs)
+fi
+
 #Loop through left and right hemispheres
 case "$Hemi" in
     (L|R|"L R"|"R L")
@@ -69,30 +126,37 @@ RegNames=`echo "$RegNamesStr" | sed s/"@"/" "/g`
 
 LowResMesh="32"
 HighResMesh="164"
-MapListFunc="MRcorrThickness MRcorrThickness_intercept MRcorrThickness_normcoeffs MRcorrThickness_curvs MRcorrThickness_coeffs"
+PatchSizes=`echo "$PatchSize" | sed s/"@"/" "/g`
+MapListFunc=""
+for Size in $PatchSizes ; do
+	#a sweep over several patch sizes tags every regression output with its size
+	Tag=""
+	if [[ "$PatchSize" == *@* ]] ; then
+		Tag="_patch$Size"
+	fi
+	MapListFunc="$MapListFunc MRcorrThickness$Tag MRcorrThickness_intercept$Tag"
+	if ((NormC)); then
+		MapListFunc="$MapListFunc MRcorrThickness_normcoeffs$Tag"
+	fi
+	MapListFunc="$MapListFunc MRcorrThickness_coeffs$Tag"
+done
+MapListFunc="$MapListFunc MRcorrThickness_curvs"
 
-#Generate MRcorrThickness in Native Space
+#Generate MRcorrThickness in Native Space, both hemispheres in one process
 if ((! SkC)); then
-	for Hemisphere in $Hemi ; do
-		if [[ "$Hemisphere" == "L" ]] ; then
-			Structure="CORTEX_LEFT"
-		elif [[ "$Hemisphere" == "R" ]] ; then
-			Structure="CORTEX_RIGHT"
-		fi
-		(
-			cd "$HCPPIPEDIR"/global/scripts/CorrThick
-			python3 CorrThick.py "$SubjectDir" "$Subject" "$Structure" "$Hemisphere" "$Surface" "$PatchSize" "$SurfSmooth" "$MetricSmooth"
-		)
-	done	
+	(
+		cd "$HCPPIPEDIR"/global/scripts/CorrThick
+		python3 CorrThickBatch.py "$SubjectDir" "$Surface" "$PatchSize" "$SurfSmooth" "$MetricSmooth" --subjects "$Subject" --hemi "${Hemi// /@}" ${CorrThickArgs[@]+"${CorrThickArgs[@]}"}
+	)
 fi
 
 #Set the Color Palette(s) and Resample to HighResMesh and LowResMesh
 for Hemisphere in $Hemi ; do
 
 	for Map in $MapListFunc ; do
-		if [[ "$Map" == MRcorrThickness || "$Map" == MRcorrThickness_intercept ]] ; then
+		if [[ "$Map" == MRcorrThickness || "$Map" == MRcorrThickness_patch* || "$Map" == MRcorrThickness_intercept* ]] ; then
 			wb_command -metric-palette "$NativeFolder"/"$Subject"."$Hemisphere"."$Map".native.shape.gii MODE_AUTO_SCALE_PERCENTAGE -pos-percent 4 96 -interpolate true -palette-name videen_style -disp-pos true -disp-neg false -disp-zero false -normalization NORMALIZATION_SELECTED_MAP_DATA
-		elif [[ "$Map" == MRcorrThickness_normcoeffs ]] ; then
+		elif [[ "$Map" == MRcorrThickness_normcoeffs* ]] ; then
 			wb_command -metric-palette "$NativeFolder"/"$Subject"."$Hemisphere"."$Map".native.shape.gii MODE_AUTO_SCALE_ABSOLUTE_PERCENTAGE -interpolate true -palette-name ROY-BIG-BL -disp-pos true -disp-neg true -disp-zero false -normalization NORMALIZATION_ALL_MAP_DATA
 		else
 			wb_command -metric-palette "$NativeFolder"/"$Subject"."$Hemisphere"."$Map".native.shape.gii MODE_AUTO_SCALE_ABSOLUTE_PERCENTAGE -interpolate true -palette-name ROY-BIG-BL -disp-pos true -disp-neg true -disp-zero false -normalization NORMALIZATION_SELECTED_MAP_DATA
@@ -132,9 +196,9 @@ if [[ "$Hemi" == *L* && "$Hemi" == *R* ]] ; then
 	
 			for Map in $MapListFunc ; do
 				wb_command -cifti-create-dense-scalar "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii -left-metric "$Folder"/"$Subject".L."$Map""$RegString"."$Mesh".shape.gii -roi-left "$Folder"/"$Subject".L."$ROI"."$Mesh".shape.gii -right-metric "$Folder"/"$Subject".R."$Map""$RegString"."$Mesh".shape.gii -roi-right "$Folder"/"$Subject".R."$ROI"."$Mesh".shape.gii
-				if [[ "$Map" == MRcorrThickness || "$Map" == MRcorrThickness_intercept ]] ; then
+				if [[ "$Map" == MRcorrThickness || "$Map" == MRcorrThickness_patch* || "$Map" == MRcorrThickness_intercept* ]] ; then
 					wb_command -cifti-palette "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii MODE_AUTO_SCALE_PERCENTAGE "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii -pos-percent 4 96 -interpolate true -palette-name videen_style -disp-pos true -disp-neg false -disp-zero false -normalization NORMALIZATION_SELECTED_MAP_DATA
-				elif [[ "$Map" == MRcorrThickness_normcoeffs ]] ; then
+				elif [[ "$Map" == MRcorrThickness_normcoeffs* ]] ; then
 					wb_command -cifti-palette "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii MODE_AUTO_SCALE_ABSOLUTE_PERCENTAGE "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii -interpolate true -palette-name ROY-BIG-BL -disp-pos true -disp-neg true -disp-zero false -normalization NORMALIZATION_ALL_MAP_DATA
 				else
 					wb_command -cifti-palette "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii MODE_AUTO_SCALE_ABSOLUTE_PERCENTAGE "$Folder"/"$Subject"."$Map""$RegString"."$Mesh".dscalar.nii -interpolate true -palette-name ROY-BIG-BL -disp-pos true -disp-neg true -disp-zero false -normalization NORMALIZATION_SELECTED_MAP_DATA
@@ -147,6 +211,8 @@ if [[ "$Hemi" == *L* && "$Hemi" == *R* ]] ; then
 	done
 fi
 
-#Remove preliminary directory and all its contents
-rm -rf "$NativeFolder"/CorrThick
+#Remove preliminary directory and all its contents, unless kept for incremental reruns
+if ((! KeepI)); then
+	rm -rf "$NativeFolder"/CorrThick
+fi
 
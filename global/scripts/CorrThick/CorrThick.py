@@ -5,38 +5,31 @@ Created on Tue Aug 20 14:44:13 2024
 
 @author: brainmappers
 """
-import sys
+import argparse
+import pipeline
 
-subjects_dir=str(sys.argv[1])
-subject=str(sys.argv[2])
-structure=str(sys.argv[3])
-hemi=str(sys.argv[4])
-surface=str(sys.argv[5])
-number=float(sys.argv[6])
-iteration=str(sys.argv[7])
-smooth=str(sys.argv[8])
+def main():
 
-import neighbor_info
-import curvature
-import metric_regression
-import roi
-import wb
+    parser = argparse.ArgumentParser(description="Curvature-corrected (folding-compensated) cortical thickness for one hemisphere.")
+    parser.add_argument("subjects_dir", type=str, help="folder containing all subjects")
+    parser.add_argument("subject", type=str, help="subject ID")
+    parser.add_argument("structure", type=str, help="CORTEX_LEFT or CORTEX_RIGHT")
+    parser.add_argument("hemi", type=str, help="L or R")
+    parser.add_argument("surface", type=str, help="white or midthickness")
+    parser.add_argument("number", type=str, help="patch kernel size in millimeters FWHM for regression, several sizes separated by @ run as one sweep with outputs tagged _patch<size>")
+    parser.add_argument("iteration", type=str, help="surface smoothing in millimeters FWHM")
+    parser.add_argument("smooth", type=str, help="metric smoothing in millimeters FWHM")
+    pipeline.add_options(parser)
+    args = parser.parse_args()
 
-################################################################################
-mesh='164k'
-wb.wb_metric_resample_to_164k(subjects_dir,subject,hemi,surface,mesh) 
-wb.wb_surf_resample_to_164k(subjects_dir,subject,hemi,surface,mesh) 
-x,y,z,a,b,c = wb.wb_taubin(subjects_dir,subject,hemi,surface,mesh,iteration)
-neighbor_info.neighbor_info(a,b,c,x,y,z,subjects_dir,subject,hemi,surface,mesh)
-curvature.Gaussian_curvature(x,y,z,subjects_dir,subject,hemi,surface)
-curvature.mean_curvature(x,y,z,subjects_dir,subject,hemi,surface)
-curvature.k1_k2_SI(x,y,z,subjects_dir,subject,hemi,surface)
-wb.wb_smooth(subjects_dir,subject,hemi,surface,mesh,smooth)
-wb.wb_rois(subjects_dir,subject,hemi,surface,mesh,number)
-rois,weights=roi.roi(subjects_dir,subject,hemi,surface,mesh,number)
-metric_regression.metric_regression(subjects_dir,subject,hemi,surface,mesh,rois,weights) 
-wb.wb_metric_resample_to_native(subjects_dir,subject,hemi,surface) 
-wb.wb_structure(subjects_dir,subject,hemi,surface,structure)
-wb.wb_set_map_names(subjects_dir,subject,hemi)
+    import runner
 
+    runner.max_workers=args.wb_jobs
 
+    ################################################################################
+    pipeline.corrthick(args.subjects_dir,args.subject,args.structure,args.hemi,args.surface,args.number.split('@'),args.iteration,args.smooth,
+                       cache_dir=args.cache_dir,cache_size=args.cache_size,normcoeffs=args.normcoeffs,geodesic=args.geodesic,smoothing_method=args.smoothing,resampling=args.resampling,regression_method=args.regression_method,save_asc=args.save_neighbors_asc)
+
+# the process pools spawn workers that import this file, they must not run the pipeline
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Curvature-corrected thickness of many subjects and both hemispheres in one process: the
+imports and the neighbor table of the shared 164k_fs_LR mesh are set up once, and while
+one hemisphere computes the next one already reads its inputs and runs its wb_command
+stages. The cores are divided between the jobs that run side by side.
+"""
+import argparse
+import sys
+import pipeline
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Curvature-corrected (folding-compensated) cortical thickness for several subjects and hemispheres.")
+    parser.add_argument("subjects_dir", type=str, help="folder containing all subjects")
+    parser.add_argument("surface", type=str, help="white or midthickness")
+    parser.add_argument("number", type=str, help="patch kernel size in millimeters FWHM for regression, several sizes separated by @ run as one sweep with outputs tagged _patch<size>")
+    parser.add_argument("iteration", type=str, help="surface smoothing in millimeters FWHM")
+    parser.add_argument("smooth", type=str, help="metric smoothing in millimeters FWHM")
+    subjects = parser.add_mutually_exclusive_group(required=True)
+    subjects.add_argument("--subjects", type=str, help="subject IDs separated by @")
+    subjects.add_argument("--subject-list", type=str, metavar="FILE", help="text file with one subject ID per line")
+    parser.add_argument("--hemi", type=str, default="L@R", help="hemispheres separated by @, default L@R")
+    parser.add_argument("--jobs", type=int, default=2, help="number of subject hemispheres processed at the same time, default 2")
+    pipeline.add_options(parser)
+    args = parser.parse_args()
+
+    if args.subject_list is not None:
+        with open(args.subject_list) as f:
+            subjects=[line.strip() for line in f if line.strip()]
+    else:
+        subjects=args.subjects.split('@')
+    structures={'L':'CORTEX_LEFT','R':'CORTEX_RIGHT'}
+    hemis=args.hemi.split('@')
+    for hemi in hemis:
+        if hemi not in structures:
+            parser.error("unrecognized hemisphere '{h}', use L or R".format(h=hemi))
+
+    from concurrent.futures import ThreadPoolExecutor
+    import runner
+
+    jobs=[(subject,hemi) for subject in subjects for hemi in hemis]
+    #every job sizes its process pools and wb_command calls by runner.max_workers, so the
+    #jobs running side by side share the cores (or --wb-jobs) instead of each taking them all
+    runner.max_workers=runner.worker_count() if args.wb_jobs is None else args.wb_jobs
+    runner.max_workers=max(1,runner.max_workers//max(1,min(args.jobs,len(jobs))))
+
+    def run(job):
+
+        subject,hemi=job
+        pipeline.corrthick(args.subjects_dir,subject,structures[hemi],hemi,args.surface,args.number.split('@'),args.iteration,args.smooth,
+                           cache_dir=args.cache_dir,cache_size=args.cache_size,normcoeffs=args.normcoeffs,geodesic=args.geodesic,smoothing_method=args.smoothing,resampling=args.resampling,regression_method=args.regression_method,save_asc=args.save_neighbors_asc)
+
+    ################################################################################
+    #a failed subject hemisphere is reported and the others continue
+    failed=[]
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for job,future in [(job,executor.submit(run,job)) for job in jobs]:
+            try:
+                future.result()
+            except Exception as e:
+                print('{sub}.{h} failed: {t}: {e}'.format(sub=job[0],h=job[1],t=type(e).__name__,e=e),file=sys.stderr)
+                failed.append(job)
+
+    if failed:
+        sys.exit('{n} of {m} subject hemispheres failed: {f}'.format(n=len(failed),m=len(jobs),f=' '.join('{sub}.{h}'.format(sub=s,h=h) for s,h in failed)))
+
+# the process pools spawn workers that import this file, they must not run the batch
+if __name__ == "__main__":
+    main()
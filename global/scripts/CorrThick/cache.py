@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of CorrThick intermediates that can be shared across subjects and runs.
+Entries live in <cache_dir>/<kind>/<key>.<ext>, where key is a hash of the data they were computed from.
+"""
+
+import os
+import re
+import hashlib
+import numpy as np
+
+# the kinds of entries written by CorrThick, eviction never looks at anything else in cache_dir
+kinds = ('topology', 'rois', 'resample')
+entry_name = re.compile(r'^[0-9a-f]{40}\.(npy|npz|unusual\.npy)$')
+
+# content hashes of files, keyed by path, size and modification time
+file_hashes = {}
+
+def array_hash(*items):
+    """
+    sha1 of the dtype, shape and contents of arrays (and the repr of any other values)
+    """
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            h.update(str((item.dtype.str, item.shape)).encode())
+            h.update(item.data)
+        else:
+            h.update(repr(item).encode())
+    return h.hexdigest()
+
+def file_hash(filename):
+    """
+    sha1 of the contents of a file, remembered while the file is unchanged
+    """
+    st = os.stat(filename)
+    stamp = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if stamp not in file_hashes:
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                h.update(block)
+        file_hashes[stamp] = h.hexdigest()
+    return file_hashes[stamp]
+
+def cache_file(cache_dir, kind, key, ext):
+    
+    folder = os.path.join(cache_dir, kind)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, '{k}.{e}'.format(k=key, e=ext))
+
+def save_npy(filename, array):
+    """
+    np.save via a temporary file and rename, so concurrent runs never see a partial entry
+    """
+    tmp_file = '{f}.{pid}.tmp.npy'.format(f=filename, pid=os.getpid())
+    np.save(tmp_file, array)
+    os.replace(tmp_file, filename)
+
+def save_npz(filename, **arrays):
+    """
+    np.savez (uncompressed) via a temporary file and rename, like save_npy
+    """
+    tmp_file = '{f}.{pid}.tmp.npz'.format(f=filename, pid=os.getpid())
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, filename)
+
+def touch(filename):
+    """
+    mark an entry as recently used, eviction removes the least recently used entries first
+    """
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+
+def evict(cache_dir, max_bytes):
+    """
+    remove the least recently used entries until the cache is at most max_bytes
+    only the entries of the known kinds count, other files in cache_dir are left alone
+    """
+    entries = []
+    for kind in kinds:
+        folder = os.path.join(cache_dir, kind)
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            continue
+        for name in names:
+            if not entry_name.match(name):
+                continue
+            filename = os.path.join(folder, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
@@ -15,237 +15,169 @@ Maria Holland, Department of Aerospace and Mechanical Engineering, University of
 import numpy as np
 import os
 import nibabel as nib
-import math
 
-def Gaussian_curvature(x,y,z,subjects_dir,subject,hemi,surface):
+def one_ring(ndl):
+    """
+    Neighbor counts and bad-topology mask from the padded neighbor table.
+    ndl: rows of [vertex, neighbors..., first neighbor, second neighbor, 0, 0, ...]
+    returns ndl as integers, nb (column of the second wraparound neighbor, 0 if not found) and the skip mask
+    """
+    ndl = np.asarray(ndl).astype(np.int64)
+    rows = np.arange(len(ndl))
+    
+    same = ndl[:, 3:] == ndl[:, 2:3] # max number of neighbor for each vertex
+    nb = np.where(same.any(axis=1), same.argmax(axis=1) + 3, 0)
+    
+    # Check for bad vertices due to bad connectivity of the mesh at that vertex
+    skip = (ndl[rows, nb - 1] != ndl[:, 1]) | (nb <= 3)
+    
+    return ndl, nb, skip
 
-    input_ndl = '{sub}.{h}.{s}.neighbor.asc'.format(sub=subject,h=hemi,s=surface) #Read the neighbor .asc file
-    ndl_file = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', input_ndl)
-    ndl = np.loadtxt(ndl_file)
-    nb = np.zeros(len(x)) # max number of neighbor for each vertex
-    for i in range(len(x)):
-        for j in range(3, len(ndl[0])):
-            if ndl[i, 2] == ndl[i, j]:
-                nb[i] = j
-                break
+def angle_defect(x,y,z,ndl,nb,skip):
+    """
+    Gaussian curvature from the angle defect of the one-ring of every vertex at once.
+    x,y,z: vertex coordinates; ndl, nb, skip: as returned by one_ring
+    returns K and the summed area of the triangles around each vertex
+    """
     max_nb = int(max(nb))
+    cols = np.arange(1, max_nb - 1)
+    nd = ndl[:, 1:max_nb] # neighbor j and j+1 for j = 1..max_nb-2
+    
+    # only the triangles of the one-ring of good vertices contribute
+    valid = (cols[np.newaxis, :] <= (nb - 2)[:, np.newaxis]) & ~skip[:, np.newaxis]
     
-    skip_vertex = np.array([]) # Check for bad vertices due to bad connectivity of the mesh at that vertex
-    for i in range(len(ndl)):
-        le = int(nb[i]-2)
-        if ndl[i, le+1] != ndl[i, 1] or nb[i] <= 3:
-            skip_vertex = np.append(skip_vertex, i) 
-    
-    dist_from_vertex = np.zeros((len(x), max_nb)) # Euclidean distance of each neighbor from the main vertex
-    for i in range(len(ndl)): 
-        nd = ndl[i]
-        le = int(nb[i]-2)
-        dist_from_vertex[i,0] = i
-        for j in range(1, le+1):
-            index = int(nd[j])
-            dist_from_vertex[i,j] = np.sqrt((x[i] - x[index])**2 + (y[i] - y[index])**2 + (z[i] - z[index])**2)
-        dist_from_vertex[i,j+1] = dist_from_vertex[i,1]
+    # Euclidean distance of each neighbor from the main vertex
+    # (coordinate differences in the surface precision, squared in float64 like the scalar arithmetic of numpy 1.x)
+    center = np.arange(len(ndl))[:, np.newaxis]
+    dist_from_vertex = np.sqrt(np.float64(x[center] - x[nd])**2 + np.float64(y[center] - y[nd])**2 + np.float64(z[center] - z[nd])**2)
+    k = dist_from_vertex[:, :-1]
+    l = dist_from_vertex[:, 1:]
+    
+    ind1 = nd[:, :-1]
+    ind2 = nd[:, 1:]
+    m = np.sqrt(np.float64(x[ind1] - x[ind2])**2 + np.float64(y[ind1] - y[ind2])**2 + np.float64(z[ind1] - z[ind2])**2)
     
     ############## Sum of internal angles #################
-    theta = np.zeros((len(x), max_nb)) # Internal angles for each triangle connecting at a specific vertex
-    param = np.zeros((len(x), max_nb)) # Semi-parameter of each triangle
-    parea = np.zeros((len(x), max_nb)) # Area of each triangle, patch area
-        
-    for h in range(len(x)): 
-        if h in skip_vertex: 
-            continue
-        nd = ndl[h]
-        le = int(nb[h]-2)
-        for j in range(1,le+1):
-            k = dist_from_vertex[h, j]
-            l = dist_from_vertex[h, j + 1]
-            ind1 = int(nd[j])
-            ind2 = int(nd[j + 1])
-            m = np.sqrt((x[ind1] - x[ind2])**2 + (y[ind1] - y[ind2])**2 + (z[ind1] - z[ind2])**2)
-            theta[h,j-1] = np.arccos((k**2 + l**2 - m**2)/(2*k*l))
-            param[h,j-1] = (k + l + m)/2
-            parea[h,j-1] = np.sqrt(param[h,j-1]*(param[h,j-1]-l)*(param[h,j-1]-k)*(param[h,j-1]-m))
-    
-    theta_sum = np.zeros(len(x)) # Sum of internal angles of each triangle meeting at each vertex
-    K_gb = np.zeros(len(x)) # Sum of angle excess or defect
-    a_sum = np.zeros(len(x)) #Sum of area of triangles meeting at each vertex
-    
-    for i in range(len(x)):
-        theta_sum[i] = sum(theta[i,:])
-        a_sum[i] = sum(parea[i,:])
-        K_gb[i] = 2*np.pi - theta_sum[i]
-        
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta = np.where(valid, np.arccos((k**2 + l**2 - m**2)/(2*k*l)), 0) # Internal angles for each triangle connecting at a specific vertex
+        param = (k + l + m)/2 # Semi-parameter of each triangle
+        parea = np.where(valid, np.sqrt(param*(param-l)*(param-k)*(param-m)), 0) # Area of each triangle, patch area
+    
+    # accumulate column by column to keep the summation order of the per-vertex sums
+    theta_sum = np.zeros(len(ndl)) # Sum of internal angles of each triangle meeting at each vertex
+    a_sum = np.zeros(len(ndl)) #Sum of area of triangles meeting at each vertex
+    for j in range(theta.shape[1]):
+        theta_sum += theta[:, j]
+        a_sum += parea[:, j]
+    K_gb = 2*np.pi - theta_sum # Sum of angle excess or defect
+    
     # Check if there are any zero areas due to mesh and/or connectivity and set a low but not zero value
-    for i in range(len(a_sum)):
-        if a_sum[i] == 0:
-            a_sum[i] = 0.001
+    a_sum[a_sum == 0] = 0.001
     K = K_gb/(a_sum/3) # This is the final Gaussian curvature
-    for i in range(len(K)):
-        if K[i] > 1000: # a very large number due to bad vertices with bad connectivity
-            K[i] = 0
-     
-    # Save gifti
-    K = np.float32(K) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(K))
-    K_name = '{sub}.{h}.{s}.K.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    K_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', K_name)
-    nib.save(data, K_name)
-    
-    a_sum = np.float32(a_sum) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(a_sum))
-    a_name = '{sub}.{h}.{s}.area.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    a_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', a_name)
-    nib.save(data, a_name)
+    K[K > 1000] = 0 # a very large number due to bad vertices with bad connectivity
     
-    return 
+    return K, a_sum
+
+def dot3(a,b):
+    """
+    Dot product of stacked 3-vectors along the last axis
+    """
+    return a[..., 0]*b[..., 0] + a[..., 1]*b[..., 1] + a[..., 2]*b[..., 2]
 
-def mean_curvature(x,y,z,subjects_dir,subject,hemi,surface):
-    
-    input_ndl = '{sub}.{h}.{s}.neighbor.asc'.format(sub=subject,h=hemi,s=surface) #Read the neighbor .asc file
-    ndl_file = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', input_ndl)
-    ndl = np.loadtxt(ndl_file)
-    nb = np.zeros(len(ndl)) # max number of neighbor for each vertex
-    for i in range(len(ndl)):
-        for j in range(3,len(ndl[0])):
-            if ndl[i, 2] == ndl[i, j]:
-                nb[i] = j
-                break
+def dihedral_sum(x,y,z,ndl,nb,skip):
+    """
+    Sum of edge-weighted dihedral angles around every vertex at once.
+    x,y,z: vertex coordinates; ndl, nb, skip: as returned by one_ring
+    returns the per-vertex sum of theta*edge, mean curvature is this /4/(area/3)
+    """
     max_nb = int(max(nb))
+    cols = np.arange(1, max_nb - 1)
     
-    skip_vertex = np.array([]) # Check for bad vertices due to bad connectivity of the mesh at that vertex
-    for i in range(len(ndl)):
-        le = int(nb[i]-2)
-        if ndl[i, le+1] != ndl[i, 1] or nb[i] <= 3:
-            skip_vertex = np.append(skip_vertex, i) 
-    ###################################################################
-    h_tri = np.zeros((len(x), max_nb))
-    for h in range(len(x)):
-        if h in skip_vertex: # skip the bad vertices with bad connectivity
-            continue
-        le = int(nb[h] + 1)
-        k = np.array(ndl[h, :le])
-        j=1
-        for i in k:
-            if j==le-2:
-                break
-            p2 = np.array([x[int(h)], y[int(h)], z[int(h)]]) #Vertex in consideration
-            ind1 = int(k[j])
-            ind2 = int(k[j+1])
-            ind3 = int(k[j+2])
-            p1 = np.array([x[ind1], y[ind1], z[ind1]])
-            p3 = np.array([x[ind2], y[ind2], z[ind2]])
-            p4 = np.array([x[ind3], y[ind3], z[ind3]])
-            q1 = np.subtract(p2,p1)
-            q2 = np.subtract(p3,p2)
-            q3 = np.subtract(p4,p3)
-            q1_x_q2 = np.cross(q1,q2)
-            q2_x_q3 = np.cross(q2,q3)
-            n1 = q1_x_q2/np.sqrt(np.dot(q1_x_q2,q1_x_q2))
-            n2 = q2_x_q3/np.sqrt(np.dot(q2_x_q3,q2_x_q3))
-            n2 = -n2
-            u1 = n2
-            u3 = q2/(np.sqrt(np.dot(q2,q2)))
-            u2 = np.cross(u3,u1)
-            cost = np.dot(n1, u1)
-            sint = np.dot(n1, u2)
-            theta = math.atan2(sint,cost) #flip the sign
-            edge = np.sqrt((x[int(h)] - x[ind2])**2 + (y[int(h)] - y[ind2])**2 + (z[int(h)] - z[ind2])**2)
-            h_tri[h, j] = theta*edge
-            j = j + 1
-    H_sum = np.zeros(len(x))
-    for i in range(len(x)):
-        H_sum[i] = sum(h_tri[i,:])   
-
-    # read the area file
-    a_name = '{sub}.{h}.{s}.area.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    a_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', a_name)
-    a_sum = nib.load(a_name)
-    a_sum = a_sum.agg_data()
-    H = H_sum/4/(a_sum/3) # This is the final mean curvature
+    # skip the bad vertices with bad connectivity
+    valid = (cols[np.newaxis, :] <= (nb - 2)[:, np.newaxis]) & ~skip[:, np.newaxis]
     
-    # Save gifti
-    H = np.float32(H) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(H))
-    H_name = '{sub}.{h}.{s}.H.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    H_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', H_name)
-    nib.save(data, H_name)
-    
-    return 
-
-def k1_k2_SI(x,y,z,subjects_dir,subject,hemi,surface):
-        
-    # read H and K 
-    H_name = '{sub}.{h}.{s}.H.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    H_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', H_name)
-    H = nib.load(H_name)
-    h = H.agg_data()
+    coords = np.stack((x, y, z), axis=-1)
+    ind1 = ndl[:, 1:max_nb - 1]
+    ind2 = ndl[:, 2:max_nb]
+    ind3 = ndl[:, 3:max_nb + 1]
+    p2 = coords[:, np.newaxis, :] #Vertex in consideration
+    p1 = coords[ind1]
+    p3 = coords[ind2]
+    p4 = coords[ind3]
+    q1 = p2 - p1
+    q2 = p3 - p2
+    q3 = p4 - p3
+    q1_x_q2 = np.cross(q1,q2)
+    q2_x_q3 = np.cross(q2,q3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n1 = q1_x_q2/np.sqrt(dot3(q1_x_q2,q1_x_q2))[..., np.newaxis]
+        n2 = q2_x_q3/np.sqrt(dot3(q2_x_q3,q2_x_q3))[..., np.newaxis]
+        n2 = -n2
+        u1 = n2
+        u3 = q2/np.sqrt(dot3(q2,q2))[..., np.newaxis]
+    u2 = np.cross(u3,u1)
+    cost = np.float64(dot3(n1, u1))
+    sint = np.float64(dot3(n1, u2))
+    theta = np.arctan2(sint,cost) #flip the sign
+    edge = np.sqrt(np.float64(x[:, np.newaxis] - x[ind2])**2 + np.float64(y[:, np.newaxis] - y[ind2])**2 + np.float64(z[:, np.newaxis] - z[ind2])**2)
+    h_tri = np.where(valid, theta*edge, 0)
+    
+    # accumulate column by column to keep the summation order of the per-vertex sums
+    H_sum = np.zeros(len(ndl))
+    for j in range(h_tri.shape[1]):
+        H_sum += h_tri[:, j]
+    
+    return H_sum
 
-    K_name = '{sub}.{h}.{s}.K.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    K_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', K_name)
-    K = nib.load(K_name)
-    k = K.agg_data()
-              
-    k1 = np.zeros(len(h))
-    k2 = np.zeros(len(h))
+def principal_curvatures(h,k):
+    """
+    Principal curvatures, shape index and curvedness from mean and Gaussian curvature.
+    h,k: H and K arrays as saved in gifti (float32)
+    returns k1, k2, SI, C
+    """
+    # calculate principal curvatures, a negative discriminant is clamped to zero
+    sqrt_term = np.float64(h)**2 - k
+    sqrt_term[sqrt_term < 0] = 0
+    k1 = h + np.sqrt(sqrt_term)
+    k2 = h - np.sqrt(sqrt_term)
+    
+    C = np.sqrt((k1*k1 + k2*k2)/2) # calculate curvedness 
+    
+    # calculate shape index, zero where k1 == k2 (umbilic points)
+    denom_term = k2 - k1
+    umbilic = denom_term == 0
     SI = np.zeros(len(h))
-    C = np.zeros(len(h))
-              
-    for i in range(len(h)):
-        sqrt_term = h[i] ** 2 - k[i] # calculate principal curvatures       
-        if sqrt_term < 0:
-            sqrt_term = 0
-        try: 
-            k1[i] = h[i] + np.sqrt(sqrt_term)
-            k2[i] = h[i] - np.sqrt(sqrt_term)
-        except Warning: 
-            print('Warning: calculating principal curvatures from', i, h[i], k[i])
-            
-        C[i]= np.sqrt((k1[i]*k1[i] + k2[i]*k2[i])/2) # calculate curvedness 
-        
-        denom_term = k2[i] - k1[i] # calculate shape index
-        if denom_term == 0: 
-            SI[i] = 0
-        else: 
-            try: 
-                SI[i] = 2 * np.arctan((k2[i] + k1[i])/denom_term)/np.pi  
-            except Warning: 
-                print ('Warning: calculating shape index from principal curvatures', k1[i], k2[i])
-                
-    # Save k1 in gifti 
-    k1 = np.float32(k1) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(k1))
-    k1_name = '{sub}.{h}.{s}.k1.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    k1_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', k1_name)
-    nib.save(data, k1_name)
-    
-    # Save k2 in gifti 
-    k2 = np.float32(k2) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(k2))
-    k2_name = '{sub}.{h}.{s}.k2.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    k2_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', k2_name)
-    nib.save(data, k2_name)
-    
-    # Save SI in gifti 
-    SI = np.float32(SI) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(SI))
-    SI_name = '{sub}.{h}.{s}.SI.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    SI_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', SI_name)
-    nib.save(data, SI_name)
-    
-    # Save C in gifti 
-    C = np.float32(C) #gifti supports float32 only
-    data = nib.gifti.gifti.GiftiImage()
-    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(C))
-    C_name = '{sub}.{h}.{s}.C.shape.gii'.format(sub=subject,h=hemi,s=surface)
-    C_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', C_name)
-    nib.save(data, C_name)
-    
-    return 
+    SI[~umbilic] = 2 * np.arctan((k2[~umbilic] + k1[~umbilic])/denom_term[~umbilic])/np.pi
+    
+    return k1, k2, SI, C
 
-       
\ No newline at end of file
+def all_curvatures(x,y,z,ndl):
+    """
+    Gaussian, mean and principal curvatures, shape index and curvedness in one pass over the one-ring structure.
+    x,y,z: vertex coordinates; ndl: neighbor table as returned by neighbor_info
+    returns a dictionary with K, area, H, k1, k2, SI and C as saved in gifti (float32)
+    """
+    ndl, nb, skip = one_ring(ndl)
+    
+    K, a_sum = angle_defect(x,y,z,ndl,nb,skip)
+    a_sum = np.float32(a_sum) #gifti supports float32 only
+    H_sum = dihedral_sum(x,y,z,ndl,nb,skip)
+    H = np.float32(H_sum/4/(a_sum/3)) # This is the final mean curvature
+    K = np.float32(K)
+    k1, k2, SI, C = principal_curvatures(H, K)
+    
+    return {'K': K, 'area': a_sum, 'H': H, 'k1': np.float32(k1), 'k2': np.float32(k2), 'SI': np.float32(SI), 'C': np.float32(C)}
+
+def curvatures(x,y,z,ndl,subjects_dir,subject,hemi,surface):
+    
+    curvs = all_curvatures(x,y,z,ndl)
+    
+    # Save gifti
+    for name, curv in curvs.items():
+        data = nib.gifti.gifti.GiftiImage()
+        data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(curv))
+        curv_name = '{sub}.{h}.{s}.{c}.shape.gii'.format(sub=subject,h=hemi,s=surface,c=name)
+        curv_name = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', curv_name)
+        nib.save(data, curv_name)
+    
+    return curvs
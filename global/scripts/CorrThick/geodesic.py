@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process geodesic neighborhoods, replacing
+wb_command -surface-geodesic-distance-sparse-text
+"""
+
+import numpy as np
+
+# graph, coordinates and search tree of the surface, set in the workers by init_worker
+shared = {}
+
+
+def surface_graph(coords, a, b, c):
+    """
+    sparse symmetric distance graph of the surface: every mesh edge with its length, and
+    for every pair of triangles sharing an edge, the straight path between the two
+    opposite vertices across the pair unfolded into a plane, where it crosses the edge
+    """
+
+    import scipy.sparse as sparse
+
+    n = len(coords)
+    tris = np.stack((a, b, c), axis=1).astype(np.int64)
+
+    # half-edges p->q with the opposite vertex of their triangle
+    p = tris.ravel()
+    q = tris[:, [1, 2, 0]].ravel()
+    o = tris[:, [2, 0, 1]].ravel()
+
+    # pair up the two half-edges of every edge
+    key = np.minimum(p, q) * n + np.maximum(p, q)
+    order = np.argsort(key, kind='stable')
+    key, p, q, o = key[order], p[order], q[order], o[order]
+    first = np.flatnonzero(key[:-1] == key[1:])
+    c1, c2 = o[first], o[first + 1]
+    p, q = p[first], q[first]
+
+    # unfold: coordinates of the opposite vertices along and away from the shared edge
+    e = coords[q] - coords[p]
+    length = np.sqrt(np.sum(e * e, axis=1))
+    e = e / length[:, np.newaxis]
+    v1 = coords[c1] - coords[p]
+    v2 = coords[c2] - coords[p]
+    x1 = np.sum(v1 * e, axis=1)
+    x2 = np.sum(v2 * e, axis=1)
+    y1 = np.sqrt(np.maximum(np.sum(v1 * v1, axis=1) - x1 * x1, 0))
+    y2 = np.sqrt(np.maximum(np.sum(v2 * v2, axis=1) - x2 * x2, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cross = x1 + (x2 - x1) * y1 / (y1 + y2)
+    valid = (cross >= 0) & (cross <= length) & (y1 + y2 > 0)
+    across = np.sqrt((x1 - x2) ** 2 + (y1 + y2) ** 2)
+
+    # both directions of edges and unfolded paths, keeping the shortest per vertex pair
+    rows = np.concatenate((p, q, c1[valid], c2[valid]))
+    cols = np.concatenate((q, p, c2[valid], c1[valid]))
+    dist = np.concatenate((length, length, across[valid], across[valid]))
+    order = np.lexsort((dist, cols, rows))
+    rows, cols, dist = rows[order], cols[order], dist[order]
+    keep = np.concatenate(([True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])))
+
+    return sparse.csr_matrix((dist[keep], (rows[keep], cols[keep])), shape=(n, n))
+
+
+def spatial_blocks(coords, size):
+    """
+    vertices grouped by cubic cells of the given edge length
+    """
+
+    cell = np.floor((coords - coords.min(axis=0)) / size).astype(np.int64)
+    _, label = np.unique(cell, axis=0, return_inverse=True)
+    label = label.ravel()
+    order = np.argsort(label, kind='stable')
+    bounds = np.flatnonzero(np.diff(label[order])) + 1
+    return np.split(order, bounds)
+
+
+def search_context(graph, coords, limit):
+
+    from scipy.spatial import cKDTree
+
+    return {'graph': graph, 'coords': coords, 'tree': cKDTree(coords), 'limit': limit}
+
+
+def init_worker(graph, coords, limit):
+
+    shared.update(search_context(graph, coords, limit))
+
+
+def block_distances(sources, context=None):
+    """
+    geodesic distances up to the limit from every source of a block
+    a path of length up to limit never leaves the ball of radius limit around its source,
+    so the search runs on the subgraph of vertices near the block only
+    context: graph, coords, tree and limit, default the ones set up by init_worker in a pool worker
+    """
+
+    from scipy.sparse.csgraph import dijkstra
+
+    if context is None:
+        context = shared
+    graph, coords, limit = context['graph'], context['coords'], context['limit']
+
+    center = coords[sources].mean(axis=0)
+    radius = np.sqrt(np.max(np.sum((coords[sources] - center) ** 2, axis=1))) + limit
+    near = np.array(context['tree'].query_ball_point(center, radius), dtype=np.int64)
+    near = np.sort(near)
+
+    sub = graph[near][:, near]
+    local = np.searchsorted(near, sources)
+    dist = dijkstra(sub, directed=True, indices=local, limit=limit)
+    reached = dist <= limit
+    cols = np.nonzero(reached)[1]
+
+    return reached.sum(axis=1), np.int32(near[cols]), np.float32(dist[reached])
+
+
+def geodesic_distances(x, y, z, a, b, c, limit, max_workers=None, block=512):
+    """
+    geodesic distances between all vertex pairs up to limit, parallelized over spatial
+    blocks of vertices, returns indptr, int32 indices and float32 distances (sorted rows)
+    block: approximate number of source vertices searched together
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    import runner
+
+    coords = np.stack((x, y, z), axis=1).astype(np.float64)
+    graph = surface_graph(coords, a, b, c)
+
+    # cells holding about block vertices at the mean vertex density of the surface
+    tris = np.stack((a, b, c), axis=1)
+    edge1 = coords[tris[:, 1]] - coords[tris[:, 0]]
+    edge2 = coords[tris[:, 2]] - coords[tris[:, 0]]
+    area = np.sum(np.linalg.norm(np.cross(edge1, edge2), axis=1)) / 2
+    blocks = spatial_blocks(coords, np.sqrt(block * area / len(coords)))
+
+    if max_workers is None:
+        max_workers = runner.worker_count()
+    if max_workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=runner.pool_context(),
+            initializer=init_worker,
+            initargs=(graph, coords, limit),
+        ) as executor:
+            results = list(executor.map(block_distances, blocks))
+    else:
+        # not through the module global, other threads may be computing other surfaces
+        context = search_context(graph, coords, limit)
+        results = [block_distances(block, context) for block in blocks]
+
+    # rows come out grouped by block, put them back in vertex order
+    counts, indices, distances = (np.concatenate(r) for r in zip(*results))
+    sources = np.concatenate(blocks)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    order = np.argsort(sources)
+    indptr = np.concatenate(([0], np.cumsum(counts[order])))
+    pos = np.repeat(starts[order] - indptr[:-1], counts[order]) + np.arange(indptr[-1])
+
+    return indptr, indices[pos], distances[pos]
@@ -2,108 +2,138 @@
 Find the neighbors of each vertex. 
 """
 
-def neighbor_info(a,b,c,x,y,z,subjects_dir,subject,hemi,surface,mesh):
+# neighbor tables built or loaded in this process, keyed by the triangles, so batch runs
+# on the same 164k_fs_LR mesh build the table once
+tables = {}
+
+def neighbor_file(subjects_dir,subject,hemi,surface,ext='npy'):
+    
+    import os
     
+    connectivity = '{sub}.{h}.{s}.neighbor.{e}'.format(sub=subject,h=hemi,s=surface,e=ext) # first two neighbors are recurring for closing the triangle loop
+    return os.path.join(subjects_dir, subject,'MNINonLinear','Native', 'CorrThick', connectivity)
+
+def load_neighbor_info(subjects_dir,subject,hemi,surface):
+    """
+    the table saved by neighbor_info, memory-mapped read-only
+    """
+    import numpy as np
+    
+    return np.load(neighbor_file(subjects_dir,subject,hemi,surface), mmap_mode='r')
+
+def neighbor_info(a,b,c,x,y,z,subjects_dir,subject,hemi,surface,mesh,save_asc=False,cache_dir=None):
+    """
+    builds the sorted one-ring of every vertex and saves it as an int32 .npy table,
+    rows are [vertex, neighbors..., first neighbor, second neighbor, 0, 0, ...]
+    save_asc: also write the table as text (neighbor.asc) for debugging
+    cache_dir: shared folder of tables keyed by the triangles, e.g. the same 164k_fs_LR mesh for every subject
+    tables already built in this process are reused with or without cache_dir
+    returns the table and the vertices with unusual topology
+    """
     import numpy as np
     import os
+    import shutil
+    import cache
     
-    neighbors_unsorted = [set() for _ in range(len(x))]
-    triangles_unsorted = [set() for _ in range(len(x))]
+    nvert = len(x)
+    tris = np.stack((a, b, c), axis=1).astype(np.int64)
     
-    def add_neighbor(neighbors, whichtri, verts, first, second):
-        triangles_unsorted[verts[first]].add(whichtri)
-        neighbors[verts[first]].add(verts[second])
-        neighbors[verts[second]].add(verts[first])
+    key = cache.array_hash(tris.astype(np.int32), nvert)
+    if key in tables:
+        neighbors_sorted, unusual = tables[key]
+        np.save(neighbor_file(subjects_dir,subject,hemi,surface), neighbors_sorted)
+        if save_asc:
+            np.savetxt(neighbor_file(subjects_dir,subject,hemi,surface,'asc'), neighbors_sorted, fmt='%-4d', delimiter=' '' ')
+        return neighbors_sorted, unusual
+    
+    if cache_dir is not None:
+        cached_file = cache.cache_file(cache_dir, 'topology', key, 'npy')
+        unusual_file = cache.cache_file(cache_dir, 'topology', key, 'unusual.npy')
+        if os.path.exists(cached_file) and os.path.exists(unusual_file):
+            cache.touch(cached_file)
+            cache.touch(unusual_file)
+            shutil.copyfile(cached_file, neighbor_file(subjects_dir,subject,hemi,surface))
+            neighbors_sorted = np.load(cached_file, mmap_mode='r')
+            if save_asc:
+                np.savetxt(neighbor_file(subjects_dir,subject,hemi,surface,'asc'), neighbors_sorted, fmt='%-4d', delimiter=' '' ')
+            tables[key] = (neighbors_sorted, np.load(unusual_file))
+            return tables[key]
+    
+    #half-edge table: every triangle contributes (center, neighbor, opposite) for each ordered pair of its vertices
+    #in a good mesh every (center, neighbor) edge is shared by exactly two triangles, giving two opposite vertices
+    center = tris[:, [0, 1, 1, 2, 2, 0]].ravel()
+    neigh = tris[:, [1, 0, 2, 1, 0, 2]].ravel()
+    opposite = tris[:, [2, 2, 0, 0, 1, 1]].ravel()
+    edge_key = center * nvert + neigh
+    order = np.argsort(edge_key, kind='stable')
+    edge_key = edge_key[order]
+    opposite = opposite[order]
+    keys, first_half, count = np.unique(edge_key, return_index=True, return_counts=True)
+    if np.any(count != 2):
+        raise RuntimeError("not good")
+    opposite1 = opposite[first_half]
+    opposite2 = opposite[first_half + 1]
+    if np.any(opposite1 == opposite2):
+        raise RuntimeError("also not good")
     
-    for triind in range(len(a)):
-        triverts = [int(a[triind]), int(b[triind]), int(c[triind])]
-        add_neighbor(neighbors_unsorted, triind, triverts, 0, 1)
-        add_neighbor(neighbors_unsorted, triind, triverts, 1, 2)
-        add_neighbor(neighbors_unsorted, triind, triverts, 2, 0)
-        
     #numneigh says how many neighbors exist per vertex
-    #numtris how many triangles use a vertex (should be the same)
-    #neighbors_unsorted has the vertices that are neighors, in an arbitrary order
-    #triangles_unsorted has the triangle indices that contain the vertex, in an arbitrary order
-    
-    maxneigh = -1
-    for vert in range(len(x)):
-        maxneigh = max(maxneigh, len(neighbors_unsorted[vert]))
-    
-    neighbors_sorted = np.zeros((len(x), maxneigh + 2))
-    numneigh = [0] * len(x)
-    firstbad = True
-    for center in range(len(x)):
-        lastneigh = -1
-        firsttri = next(iter(triangles_unsorted[center]))
-        myverts = [int(a[firsttri]), int(b[firsttri]), int(c[firsttri])]
-        for i in range(3):
-            if myverts[i] == center:
-                break
-        firstneigh = myverts[(i + 1) % 3]
-        curneigh = myverts[(i + 1) % 3]
-        nextneigh = myverts[(i + 2) % 3]
-        neighbors_sorted[center, numneigh[center]] = firstneigh
-        numneigh[center] += 1
-        used = {curneigh}
-        while True:
-            lastneigh = curneigh
-            curneigh = nextneigh
-            used.add(curneigh)
-            neighbors_sorted[center, numneigh[center]] = curneigh
-            numneigh[center] += 1
-            
-            #this should only give two triangles
-            possibletris = triangles_unsorted[center].intersection(triangles_unsorted[curneigh])
-            if len(possibletris) != 2:
-                raise RuntimeError("not good")
-            possibleverts = set()
-            for sometri in possibletris:
-                possibleverts |= {int(a[sometri]), int(b[sometri]), int(c[sometri])}
-            #should have 4 verts: center, prev, cur, and next, so...
-            if len(possibleverts) != 4:
-                raise RuntimeError("also not good")
-            possibleverts.remove(curneigh)
-            possibleverts.remove(center)
-            possibleverts.remove(lastneigh)
-            if len(possibleverts) != 1:
-                raise RuntimeError("very not good")
-            nextneigh = next(iter(possibleverts))
-            
-            if nextneigh == -1:
-                raise RuntimeError("uhoh")
-            if nextneigh in used:
-                if nextneigh != firstneigh:
-                    print('warning: vertex {} has unusual topology'.format(center))
-                    if firstbad:
-                        firstbad = False
-                        print(neighbors_unsorted[center])
-                        print(triangles_unsorted[center])
-                        for tri in triangles_unsorted[center]:
-                            print([int(a[tri]), int(b[tri]), int(c[tri])])
-                        print(neighbors_sorted[center])
-                break
-        #add the extra wraparound vertices
-        for i in range(2):
-            neighbors_sorted[center, numneigh[center] + i] = neighbors_sorted[center, i]
-            
-        # add a new first column with vertex indices
-    
-    indices = np.arange(len(x))
-    neighbors_sorted = np.transpose(np.vstack((indices, np.transpose(neighbors_sorted))))
-    
-    # put more columns of zero at the end
-    zeros = np.zeros(len(x))
-    neighbors_sorted = np.transpose(np.vstack((np.transpose(neighbors_sorted), zeros)))
-    neighbors_sorted = np.transpose(np.vstack((np.transpose(neighbors_sorted), zeros)))
-    neighbors_sorted = np.transpose(np.vstack((np.transpose(neighbors_sorted), zeros)))
-    neighbors_sorted = np.transpose(np.vstack((np.transpose(neighbors_sorted), zeros)))
-    neighbors_sorted = np.transpose(np.vstack((np.transpose(neighbors_sorted), zeros)))
-    
-    ######################## Save to asc file #############################
-    connectivity = '{sub}.{h}.{s}.neighbor.asc'.format(sub=subject,h=hemi,s=surface) # first two neighbors are recurring for closing the triangle loop
-    save_file = os.path.join(subjects_dir, subject,'MNINonLinear','Native', 'CorrThick', connectivity)
-    np.savetxt(save_file, neighbors_sorted, fmt='%-4d', delimiter=' '' ')
-    
-    return neighbors_sorted
-
+    numneigh_total = np.bincount(keys // nvert, minlength=nvert)
+    maxneigh = numneigh_total.max()
+    
+    #start each fan from the first triangle that uses the vertex, in the triangle's winding order
+    corners = tris.ravel()
+    verts, first_corner = np.unique(corners, return_index=True)
+    if len(verts) != nvert:
+        raise RuntimeError("uhoh")
+    firsttri = first_corner // 3
+    i = first_corner % 3
+    firstneigh = tris[firsttri, (i + 1) % 3]
+    nextneigh = tris[firsttri, (i + 2) % 3]
+    
+    neighbors_sorted = np.zeros((nvert, maxneigh + 2), dtype=np.int64)
+    numneigh = np.full(nvert, 2)
+    neighbors_sorted[:, 0] = firstneigh
+    neighbors_sorted[:, 1] = nextneigh
+    unusual = np.zeros(nvert, dtype=bool)
+    
+    #walk all fans at once, one neighbor per step: the next neighbor is the vertex opposite the previous one across the current edge
+    active = np.arange(nvert)
+    lastneigh = firstneigh
+    curneigh = nextneigh
+    while len(active) > 0:
+        edge = np.searchsorted(keys, active * nvert + curneigh)
+        nextneigh = np.where(opposite1[edge] == lastneigh, opposite2[edge], opposite1[edge])
+        if np.any((opposite1[edge] != lastneigh) & (opposite2[edge] != lastneigh)):
+            raise RuntimeError("very not good")
+        
+        used = np.any((neighbors_sorted[active] == nextneigh[:, np.newaxis]) & (np.arange(maxneigh + 2) < numneigh[active, np.newaxis]), axis=1)
+        #a fan that closes on anything but its first neighbor has unusual topology
+        unusual[active[used & (nextneigh != neighbors_sorted[active, 0])]] = True
+        
+        keep = ~used
+        active = active[keep]
+        lastneigh = curneigh[keep]
+        curneigh = nextneigh[keep]
+        neighbors_sorted[active, numneigh[active]] = curneigh
+        numneigh[active] += 1
+    
+    #add the extra wraparound vertices
+    rows = np.arange(nvert)
+    for i in range(2):
+        neighbors_sorted[rows, numneigh + i] = neighbors_sorted[rows, i]
+    
+    # add a new first column with vertex indices, put more columns of zero at the end
+    neighbors_sorted = np.hstack((rows[:, np.newaxis], neighbors_sorted, np.zeros((nvert, 5), dtype=np.int64))).astype(np.int32)
+    
+    ######################## Save to npy file #############################
+    np.save(neighbor_file(subjects_dir,subject,hemi,surface), neighbors_sorted)
+    if save_asc:
+        np.savetxt(neighbor_file(subjects_dir,subject,hemi,surface,'asc'), neighbors_sorted, fmt='%-4d', delimiter=' '' ')
+    
+    unusual = np.flatnonzero(unusual)
+    if cache_dir is not None:
+        cache.save_npy(unusual_file, unusual)
+        cache.save_npy(cached_file, neighbors_sorted)
+    tables[key] = (neighbors_sorted, unusual)
+    
+    return neighbors_sorted, unusual
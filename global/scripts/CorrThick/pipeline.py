@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The CorrThick pipeline of one subject and hemisphere as a graph of checkpointed stages,
+shared by CorrThick.py (one hemisphere) and CorrThickBatch.py (many subjects and hemispheres)
+"""
+
+import os
+
+def add_options(parser):
+    
+    #options common to both entry points
+    parser.add_argument("--cache-dir", type=str, default=None, help="shared folder for cached intermediates, e.g. the 164k_fs_LR mesh topology and geodesic patches")
+    parser.add_argument("--cache-size", type=float, default=20, help="maximum size of the cache folder in GB, least recently used entries are removed beyond it")
+    parser.add_argument("--no-normcoeffs", dest="normcoeffs", action="store_false", help="skip computing and saving the MAD-normalized regression coefficients")
+    parser.add_argument("--geodesic", choices=["wb", "internal"], default="wb", help="geodesic patches from wb_command sparse text output (wb) or computed in-process (internal)")
+    parser.add_argument("--smoothing", choices=["wb", "internal"], default="wb", help="surface and curvature smoothing with wb_command -metric-smoothing (wb) or in-process with one sparse smoothing operator per surface and kernel, applied to all maps at once (internal, experimental: the Gaussian times vertex area rows are normalized to sum 1, unlike GEO_GAUSS_AREA, so results are close to but not equal to wb's and no tolerance against wb is established)")
+    parser.add_argument("--resampling", choices=["wb", "internal"], default="wb", help="164k/native metric resampling with wb_command -metric-resample ADAP_BARY_AREA (wb) or with cached sparse resampling matrices in-process (internal, experimental: approximates ADAP_BARY_AREA, the area correction uses the current surface only instead of both -area-surfs, close to but not equal to wb's, no tolerance against wb is established)")
+    parser.add_argument("--regression-method", choices=["batched", "sparse", "pool"], default="batched", help="how the patch regressions are solved: stacked systems in this process (batched), normal equations from sparse products (sparse, summed in a different order, within 1e-3 of the largest value of each batched output, up to about 4e-4 seen on real surfaces) or ranges of patches in a process pool (pool)")
+    parser.add_argument("--save-neighbors-asc", action="store_true", help="also write the vertex neighbor table as text (<subject>.<hemi>.<surface>.neighbor.asc) for debugging")
+    parser.add_argument("--wb-jobs", type=int, default=None, help="maximum number of independent wb_command calls and pool processes of a subject hemisphere run at the same time, default the number of physical cores, divided between the --jobs of a batch")
+
+def corrthick(subjects_dir,subject,structure,hemi,surface,sizes,iteration,smooth,cache_dir=None,cache_size=20,normcoeffs=True,geodesic='wb',smoothing_method='wb',resampling='wb',regression_method='batched',save_asc=False):
+    """
+    curvature-corrected thickness of one subject and hemisphere, skipping the stages that
+    are up to date
+    sizes: patch sizes as strings, several sizes are computed from one set of geodesic patches
+    regression_method: 'batched', 'sparse' or 'pool', see metric_regression
+    save_asc: also write the neighbor table as text for debugging
+    """
+    
+    import nibabel as nib
+    import cache
+    import neighbor_info
+    import curvature
+    import metric_regression
+    import resample
+    import roi
+    import smoothing
+    import stages
+    import wb
+    
+    numbers=[float(size) for size in sizes]
+    tags=[''] if len(sizes)==1 else ['_patch'+size for size in sizes]
+    number=max(numbers)
+    
+    mesh='164k'
+    native=os.path.join(subjects_dir,subject,'MNINonLinear','Native')
+    work=os.path.join(native,'CorrThick')
+
+    def native_file(name):
+        return os.path.join(native,'{sub}.{h}.{n}'.format(sub=subject,h=hemi,n=name))
+
+    def work_file(name):
+        return os.path.join(work,'{sub}.{h}.{n}'.format(sub=subject,h=hemi,n=name))
+
+    native_sphere=native_file('sphere.native.surf.gii')
+    native_surf=os.path.join(subjects_dir,subject,'T1w','Native','{sub}.{h}.{s}.native.surf.gii'.format(sub=subject,h=hemi,s=surface))
+    sphere_164k=os.path.join(subjects_dir,subject,'MNINonLinear','{sub}.{h}.sphere.164k_fs_LR.surf.gii'.format(sub=subject,h=hemi))
+    surf_164k=os.path.join(subjects_dir,subject,'MNINonLinear','{sub}.{h}.{s}.164k_fs_LR.surf.gii'.format(sub=subject,h=hemi,s=surface))
+    thickness=work_file('thickness.{m}.resample.shape.gii'.format(m=mesh))
+    resample_surf=work_file('{s}.{m}.resample.surf.gii'.format(s=surface,m=mesh))
+    smooth_surf=work_file('{s}.{m}.resample.smooth.surf.gii'.format(s=surface,m=mesh))
+    curv_names=['H','K','k1','k2','C','SI']
+    curv_files=[work_file('{s}.{c}.shape.gii'.format(s=surface,c=c)) for c in curv_names+['area']]
+    smooth_files=[work_file('{s}.{c}.smooth.shape.gii'.format(s=surface,c=c)) for c in curv_names]
+    roi_file=work_file('{s}.roi.{m}.npz'.format(s=surface,m=mesh))
+    input_names,output_names=wb.regression_names(normcoeffs,tags)
+    regression_files=[work_file('{s}.{n}.shape.gii'.format(s=surface,n=n)) for n in input_names]
+    native_files=[native_file('{n}.native.shape.gii'.format(n=n)) for n in output_names]
+    neighbor_files=[neighbor_info.neighbor_file(subjects_dir,subject,hemi,surface)]
+    if save_asc:
+        neighbor_files.append(neighbor_info.neighbor_file(subjects_dir,subject,hemi,surface,'asc'))
+
+    def load_smooth_surface():
+        coords,triangles=resample.load_surface(smooth_surf)
+        return coords[:,0],coords[:,1],coords[:,2],triangles[:,0],triangles[:,1],triangles[:,2]
+
+    def resample_thickness():
+        if resampling=='wb':
+            wb.wb_metric_resample_to_164k(subjects_dir,subject,hemi,surface,mesh)
+        else:
+            resample.resample_to_164k(subjects_dir,subject,hemi,surface,mesh,cache_dir)
+
+    def resample_surface():
+        wb.wb_surf_resample_to_164k(subjects_dir,subject,hemi,surface,mesh)
+
+    def taubin():
+        if smoothing_method=='wb':
+            wb.wb_taubin(subjects_dir,subject,hemi,surface,mesh,iteration)
+        else:
+            smoothing.taubin(subjects_dir,subject,hemi,surface,mesh,iteration)
+
+    def neighbors():
+        #taubin smoothing moves the vertices only, the resampled surface has the same triangles
+        coords,triangles=resample.load_surface(resample_surf)
+        ndl,unusual=neighbor_info.neighbor_info(triangles[:,0],triangles[:,1],triangles[:,2],coords[:,0],coords[:,1],coords[:,2],subjects_dir,subject,hemi,surface,mesh,save_asc=save_asc,cache_dir=cache_dir)
+        if len(unusual) > 0:
+            print('warning: {n} vertices have unusual topology: {v}'.format(n=len(unusual),v=unusual))
+
+    def curvatures():
+        x,y,z,a,b,c=load_smooth_surface()
+        ndl=neighbor_info.load_neighbor_info(subjects_dir,subject,hemi,surface)
+        curvature.curvatures(x,y,z,ndl,subjects_dir,subject,hemi,surface)
+        wb.wb_set_structure(curv_files[:len(curv_names)],structure)
+
+    def smooth_curvatures():
+        if smoothing_method=='wb':
+            wb.wb_smooth(subjects_dir,subject,hemi,surface,mesh,smooth)
+        else:
+            x,y,z,a,b,c=load_smooth_surface()
+            curvs={name:nib.load(f).agg_data() for name,f in zip(curv_names,curv_files)}
+            smoothing.smooth_curvatures(x,y,z,a,b,c,curvs,subjects_dir,subject,hemi,surface,smooth)
+        wb.wb_set_structure(smooth_files,structure)
+
+    def rois():
+        x,y,z,a,b,c=load_smooth_surface()
+        patches=None
+        if cache_dir is not None:
+            roi_key=roi.cache_key(x,y,z,a,b,c,number,geodesic)
+            patches=roi.load_cached_roi(cache_dir,roi_key,number)
+        if patches is None:
+            if geodesic=='wb':
+                wb.wb_rois(subjects_dir,subject,hemi,surface,mesh,number)
+                patches=roi.roi(subjects_dir,subject,hemi,surface,mesh,number)
+            else:
+                patches=roi.geodesic_roi(x,y,z,a,b,c,number)
+            if cache_dir is not None:
+                roi.save_cached_roi(cache_dir,roi_key,patches)
+                cache.evict(cache_dir,cache_size*1e9)
+        roi.save_roi(roi_file,patches)
+
+    def regression():
+        #geodesic distances are computed once for the largest patch, smaller patches are filtered from them
+        patches=roi.load_roi(roi_file,number)
+        for size,tag in zip(numbers,tags):
+            size_rois=patches if size==number else roi.restrict(patches,size)
+            metric_regression.metric_regression(subjects_dir,subject,hemi,surface,mesh,size_rois,method=regression_method,normcoeffs=normcoeffs,tag=tag)
+
+    def resample_outputs():
+        if resampling=='wb':
+            wb.wb_metric_resample_to_native(subjects_dir,subject,hemi,surface,normcoeffs,tags)
+        else:
+            resample.resample_to_native(subjects_dir,subject,hemi,surface,normcoeffs,tags,cache_dir)
+        wb.wb_set_structure(native_files,structure)
+        wb.wb_set_map_names(subjects_dir,subject,hemi,normcoeffs,tags)
+
+    #every stage reruns only when its parameters, input files or upstream stages changed,
+    #the two resamples and the curvature smoothing and geodesic patches run side by side
+    pipeline=[
+        stages.Stage('resample_thickness',resample_thickness,[],[native_file('thickness.native.shape.gii'),native_sphere,sphere_164k,native_surf,native_file('roi.native.shape.gii')],[thickness],(mesh,resampling)),
+        stages.Stage('resample_surface',resample_surface,[],[native_surf,native_sphere,sphere_164k],[resample_surf],(mesh,)),
+        stages.Stage('taubin',taubin,['resample_surface'],[],[smooth_surf],(iteration,smoothing_method)),
+        stages.Stage('neighbors',neighbors,['resample_surface'],[],neighbor_files,()),
+        stages.Stage('curvature',curvatures,['taubin','neighbors'],[],curv_files,(structure,)),
+        stages.Stage('smooth',smooth_curvatures,['taubin','curvature'],[],smooth_files,(smooth,smoothing_method,structure)),
+        stages.Stage('rois',rois,['taubin'],[],[roi_file],(number,geodesic)),
+        stages.Stage('regression',regression,['resample_thickness','smooth','rois'],[],regression_files,(numbers,tags,normcoeffs,regression_method)),
+        stages.Stage('resample_native',resample_outputs,['regression'],[sphere_164k,native_sphere,surf_164k,native_surf],native_files,(resampling,structure)),
+    ]
+    stages.run_stages(pipeline,work_file('{s}.stages'.format(s=surface)),label='{sub}.{h}: '.format(sub=subject,h=hemi))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process metric resampling between the native and 164k_fs_LR meshes, replacing
+wb_command -metric-resample ADAP_BARY_AREA
+"""
+
+import os
+import threading
+import collections
+import numpy as np
+import nibabel as nib
+
+# the most recently used resampling matrices, keyed by spheres, area surfaces and roi;
+# they are per subject and about 100 MB each, so a batch process keeps only a few
+max_matrices = 4
+matrices = collections.OrderedDict()
+matrices_lock = threading.Lock()
+
+
+def remember(key, matrix):
+    """
+    keep a matrix as the most recently used one, dropping the least recently used beyond max_matrices
+    """
+
+    with matrices_lock:
+        matrices[key] = matrix
+        matrices.move_to_end(key)
+        while len(matrices) > max_matrices:
+            matrices.popitem(last=False)
+    return matrix
+
+
+def barycentric_weights(points, coords, tris, k=4):
+    """
+    enclosing triangle and barycentric weights of every point on a sphere mesh
+    the triangles around the k nearest vertices are tested, a point is projected onto a
+    triangle along the ray from the sphere center, and the triangle with the largest
+    smallest weight is kept (all weights >= 0 when the point is inside it)
+    """
+
+    from scipy.spatial import cKDTree
+
+    n = len(coords)
+    _, near = cKDTree(coords).query(points, k)
+
+    # triangles around every vertex
+    owner = tris.ravel()
+    order = np.argsort(owner, kind='stable')
+    tri_of = order // 3
+    ptr = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=n))))
+    valence = np.diff(ptr)
+
+    best_tri = np.zeros(len(points), dtype=np.int64)
+    best_w = np.zeros((len(points), 3))
+    best_score = np.full(len(points), -np.inf)
+    for kk in range(k):
+        v = near[:, kk]
+        for m in range(valence.max()):
+            has = m < valence[v]
+            t = tri_of[ptr[v] + np.minimum(m, valence[v] - 1)]
+            A, B, C = (coords[tris[t, i]] for i in range(3))
+            w = np.stack(
+                (
+                    np.sum(points * np.cross(B, C), axis=1),
+                    np.sum(points * np.cross(C, A), axis=1),
+                    np.sum(points * np.cross(A, B), axis=1),
+                ),
+                axis=1,
+            )
+            total = w.sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                w = w / total[:, np.newaxis]
+            score = np.where(has & (total > 0), w.min(axis=1), -np.inf)
+            better = score > best_score
+            best_tri[better] = t[better]
+            best_w[better] = w[better]
+            best_score[better] = score[better]
+
+    # points just outside every tested triangle snap to the nearest one
+    best_w = np.maximum(best_w, 0)
+    best_w = best_w / best_w.sum(axis=1)[:, np.newaxis]
+    return best_tri, best_w
+
+
+def adap_bary_area(current_sphere, new_sphere, current_area_surf, roi=None):
+    """
+    sparse new-by-current resampling matrix in the manner of ADAP_BARY_AREA: each new
+    vertex uses forward barycentric weights (its triangle on the current sphere) or, where
+    more current vertices map onto it, the reverse barycentric weights (current vertices
+    in triangles of the new sphere), weighted by current vertex area and normalized
+    this only approximates wb_command -metric-resample ADAP_BARY_AREA -area-surfs, whose
+    area correction uses the vertex areas of both the current and the new surface, so the
+    outputs are close to but not equal to wb's
+    current_sphere, new_sphere, current_area_surf: (coords, triangles) pairs
+    roi: optional mask of valid current vertices
+    """
+
+    import scipy.sparse as sparse
+    import smoothing
+
+    cur_coords, cur_tris = np.float64(current_sphere[0]), np.int64(current_sphere[1])
+    new_coords, new_tris = np.float64(new_sphere[0]), np.int64(new_sphere[1])
+    n_cur, n_new = len(cur_coords), len(new_coords)
+
+    tri, w = barycentric_weights(new_coords, cur_coords, cur_tris)
+    forward = sparse.csr_matrix(
+        (w.ravel(), (np.repeat(np.arange(n_new), 3), cur_tris[tri].ravel())),
+        shape=(n_new, n_cur),
+    )
+    tri, w = barycentric_weights(cur_coords, new_coords, new_tris)
+    reverse = sparse.csr_matrix(
+        (w.ravel(), (new_tris[tri].ravel(), np.repeat(np.arange(n_cur), 3))),
+        shape=(n_new, n_cur),
+    )
+    forward.eliminate_zeros()
+    reverse.eliminate_zeros()
+
+    # per new vertex, the direction with more contributing current vertices
+    use_reverse = np.diff(reverse.indptr) > np.diff(forward.indptr)
+    matrix = sparse.diags(np.float64(use_reverse)) @ reverse
+    matrix = matrix + sparse.diags(np.float64(~use_reverse)) @ forward
+
+    # area correction and roi, then normalize every row that has valid weights
+    area = smoothing.vertex_areas(np.float64(current_area_surf[0]), np.int64(current_area_surf[1]))
+    if roi is not None:
+        area = area * (np.asarray(roi) > 0)
+    matrix = matrix @ sparse.diags(area)
+    total = np.asarray(matrix.sum(axis=1)).ravel()
+    scale = np.divide(1, total, out=np.zeros(n_new), where=total > 0)
+    return sparse.csr_matrix(sparse.diags(scale) @ matrix)
+
+
+def load_surface(filename):
+
+    img = nib.load(filename)
+    return img.agg_data('NIFTI_INTENT_POINTSET'), img.agg_data('NIFTI_INTENT_TRIANGLE')
+
+
+def resample_matrix(current_sphere, new_sphere, current_area, roi_file=None, cache_dir=None):
+    """
+    resampling matrix between two sphere files, kept in memory among the last max_matrices and,
+    with a cache_dir, stored under <cache_dir>/resample keyed by the inputs' contents
+    """
+
+    import scipy.sparse as sparse
+    import cache
+
+    surfs = [load_surface(f) for f in (current_sphere, new_sphere, current_area)]
+    roi = nib.load(roi_file).agg_data() if roi_file is not None else None
+    arrays = [array for surf in surfs for array in surf] + ([roi] if roi is not None else [])
+    key = cache.array_hash(*arrays)
+    with matrices_lock:
+        matrix = matrices.get(key)
+    if matrix is not None:
+        return remember(key, matrix)
+
+    cached_file = None
+    if cache_dir is not None:
+        cached_file = cache.cache_file(cache_dir, 'resample', key, 'npz')
+        if os.path.exists(cached_file):
+            cache.touch(cached_file)
+            return remember(key, sparse.load_npz(cached_file))
+
+    matrix = adap_bary_area(surfs[0], surfs[1], surfs[2], roi)
+    if cached_file is not None:
+        tmp_file = '{f}.{pid}.tmp.npz'.format(f=cached_file, pid=os.getpid())
+        sparse.save_npz(tmp_file, matrix, compressed=False)
+        os.replace(tmp_file, cached_file)
+    return remember(key, matrix)
+
+
+def resample_to_164k(subjects_dir, subject, hemi, surface, mesh, cache_dir=None):
+    """
+    in-process equivalent of wb.wb_metric_resample_to_164k
+    """
+
+    input_file = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', '{sub}.{h}.thickness.native.shape.gii'.format(sub=subject, h=hemi))
+    input_sphere = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', '{sub}.{h}.sphere.native.surf.gii'.format(sub=subject, h=hemi))
+    output_sphere = os.path.join(subjects_dir, subject, 'MNINonLinear', '{sub}.{h}.sphere.164k_fs_LR.surf.gii'.format(sub=subject, h=hemi))
+    output_file = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', 'CorrThick', '{sub}.{h}.thickness.{m}.resample.shape.gii'.format(sub=subject, h=hemi, m=mesh))
+    input_surf = os.path.join(subjects_dir, subject, 'T1w', 'Native', '{sub}.{h}.{s}.native.surf.gii'.format(sub=subject, s=surface, h=hemi))
+    roi_file = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', '{sub}.{h}.roi.native.shape.gii'.format(sub=subject, h=hemi))
+
+    matrix = resample_matrix(input_sphere, output_sphere, input_surf, roi_file, cache_dir)
+    data = nib.gifti.gifti.GiftiImage()
+    data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(np.float32(matrix @ np.float64(nib.load(input_file).agg_data()))))
+    nib.save(data, output_file)
+
+
+def resample_to_native(subjects_dir, subject, hemi, surface, normcoeffs=True, tags=[''], cache_dir=None):
+    """
+    in-process equivalent of wb.wb_metric_resample_to_native: all regression outputs are
+    stacked into one array and resampled with a single sparse product
+    """
+
+    import wb
+
+    input_names, output_names = wb.regression_names(normcoeffs, tags)
+    input_sphere = os.path.join(subjects_dir, subject, 'MNINonLinear', '{sub}.{h}.sphere.164k_fs_LR.surf.gii'.format(sub=subject, h=hemi))
+    output_sphere = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', '{sub}.{h}.sphere.native.surf.gii'.format(sub=subject, h=hemi))
+    input_surf = os.path.join(subjects_dir, subject, 'MNINonLinear', '{sub}.{h}.{s}.164k_fs_LR.surf.gii'.format(sub=subject, s=surface, h=hemi))
+
+    columns = []
+    for name in input_names:
+        input_file = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', 'CorrThick', '{sub}.{h}.{s}.{inp}.shape.gii'.format(sub=subject, h=hemi, s=surface, inp=name))
+        column = nib.load(input_file).agg_data()
+        if isinstance(column, tuple):  # one data array per map
+            column = np.stack(column, axis=1)
+        column = np.float64(column)
+        columns.append(column.reshape(len(column), -1))
+    widths = [column.shape[1] for column in columns]
+
+    matrix = resample_matrix(input_sphere, output_sphere, input_surf, cache_dir=cache_dir)
+    resampled = np.float32(matrix @ np.hstack(columns))
+
+    # one data array per map, like wb_command metric files
+    start = 0
+    for name, width in zip(output_names, widths):
+        data = nib.gifti.gifti.GiftiImage()
+        for i in range(start, start + width):
+            data.add_gifti_data_array(nib.gifti.gifti.GiftiDataArray(resampled[:, i]))
+        output_file = os.path.join(subjects_dir, subject, 'MNINonLinear', 'Native', '{sub}.{h}.{out}.native.shape.gii'.format(sub=subject, h=hemi, out=name))
+        nib.save(data, output_file)
+        start += width
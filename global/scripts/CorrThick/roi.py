@@ -6,37 +6,179 @@ Created on Sun Apr 28 17:45:23 2024
 @author: brainmappers
 """
 
+import collections
+
+# geodesic patches of all vertices in compressed sparse row form: the patch of vertex i
+# is indices[indptr[i]:indptr[i+1]] (sorted), with matching distances and Gaussian weights
+Rois = collections.namedtuple('Rois', ['indptr', 'indices', 'distances', 'weights'])
+
 def roi(subjects_dir,subject,hemi,surface,mesh,number):
-    
+
     import os
-    import numpy as np
-    import math
-    
+
     if mesh=='164k':
         m=163842
-        
-    #read csv file and save as lists in a list array (weights and rois-vertices)
-    rois=[None]*m
-    weights=[None]*m
-    i=0
+
+    #read csv file into one sparse row structure of patch vertices, distances and weights
     roi_file = os.path.join(subjects_dir, subject, 'MNINonLinear','Native', 'CorrThick', '{sub}.{h}.{s}.roi.{m}.csv'.format(sub=subject,h=hemi,s=surface,m=mesh))
-    sigma = number / math.sqrt(2 * math.log(2))
-    
-    with open(roi_file) as f:
-        for line in f:
-            l = line.split(',')
-            roi = np.array([int(ele) for ele in l[::2]], dtype=np.int32)
-            distance = np.array([float(ele) for ele in l[1::2]], dtype=np.float32)
-            roi, distance = zip(*sorted(zip(roi, distance)))
-            roi=np.array(roi)
-            distance=np.array(distance)
-            weight = np.exp(-0.5*((distance)/sigma)**2)
-            weight = weight/np.sum(weight)
-            rois[i]=roi
-            weights[i]=weight
-            i=i+1
-            
+    indptr, indices, distances = read_geodesic_text(roi_file)
+    if len(indptr) - 1 != m:
+        raise RuntimeError('{f} has {n} rows, expected {m}'.format(f=roi_file,n=len(indptr)-1,m=m))
+
     os.remove(roi_file)
-                
-    return rois, weights
 
+    return Rois(indptr, indices, distances, gaussian_weights(indptr, distances, number))
+
+def geodesic_roi(x,y,z,a,b,c,number):
+
+    import geodesic
+
+    #geodesic neighborhoods up to 3 sigma computed in-process on the smoothed surface
+    indptr, indices, distances = geodesic.geodesic_distances(x,y,z,a,b,c,cutoff(number))
+
+    return Rois(indptr, indices, distances, gaussian_weights(indptr, distances, number))
+
+def cutoff(number):
+
+    import math
+
+    #take "number" as HWHM, convert via FWHM, patches extend to 3 sigma
+    sigma = number / math.sqrt(2 * math.log(2))
+    return sigma * 3
+
+def cache_key(x,y,z,a,b,c,number,geodesic):
+
+    import numpy as np
+    import cache
+
+    #patches depend only on the smoothed surface, the distance cutoff and how distances are computed
+    coords = np.stack((x,y,z), axis=1).astype(np.float32)
+    tris = np.stack((a,b,c), axis=1).astype(np.int32)
+    return cache.array_hash(coords, tris, cutoff(number), geodesic)
+
+def load_cached_roi(cache_dir,key,number):
+
+    import os
+    import cache
+
+    cached_file = cache.cache_file(cache_dir, 'rois', key, 'npz')
+    if not os.path.exists(cached_file):
+        return None
+    cache.touch(cached_file)
+
+    return load_roi(cached_file,number)
+
+def save_cached_roi(cache_dir,key,rois):
+
+    import cache
+
+    save_roi(cache.cache_file(cache_dir, 'rois', key, 'npz'),rois)
+
+def load_roi(roi_file,number):
+
+    import numpy as np
+
+    #weights are cheap to recompute, only vertices and distances are stored
+    with np.load(roi_file) as f:
+        indptr, indices, distances = f['indptr'], f['indices'], f['distances']
+
+    return Rois(indptr, indices, distances, gaussian_weights(indptr, distances, number))
+
+def save_roi(roi_file,rois):
+
+    import cache
+
+    cache.save_npz(roi_file, indptr=rois.indptr, indices=rois.indices, distances=rois.distances)
+
+def restrict(rois, number):
+
+    import numpy as np
+
+    #patches of a smaller size are the parts of larger patches within the smaller cutoff
+    keep = rois.distances <= cutoff(number)
+    counts = np.add.reduceat(np.int64(keep), rois.indptr[:-1])
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    indices = rois.indices[keep]
+    distances = rois.distances[keep]
+
+    return Rois(indptr, indices, distances, gaussian_weights(indptr, distances, number))
+
+def gaussian_weights(indptr, distances, number):
+
+    import numpy as np
+    import math
+
+    #take "number" as HWHM, convert via FWHM, and normalize every patch to sum 1
+    sigma = number / math.sqrt(2 * math.log(2))
+    weight = np.exp(-0.5*((distances)/sigma)**2)
+    total = np.add.reduceat(np.float64(weight), indptr[:-1])
+    return np.float32(weight / np.repeat(total, np.diff(indptr)))
+
+def read_geodesic_text(roi_file, chunk_bytes=2**26, max_workers=None):
+    """
+    parse wb_command -surface-geodesic-distance-sparse-text output ("vertex,distance,..." per
+    line) in chunks of whole lines, parallelized over runner.worker_count() processes, returns indptr,
+    int32 indices and float32 distances with every row sorted by vertex
+    """
+
+    import os
+    import numpy as np
+    from concurrent.futures import ProcessPoolExecutor
+    import runner
+
+    #split the file into byte ranges that start at line beginnings
+    size = os.path.getsize(roi_file)
+    starts = [0]
+    with open(roi_file, 'rb') as f:
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    ranges = [(roi_file, start, stop) for start, stop in zip(starts, starts[1:] + [size])]
+
+    if max_workers is None:
+        max_workers = runner.worker_count()
+    if max_workers > 1 and len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=runner.pool_context()) as executor:
+            chunks = list(executor.map(parse_range, ranges))
+    else:
+        chunks = [parse_range(r) for r in ranges]
+
+    counts, indices, distances = (np.concatenate(c) for c in zip(*chunks))
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    return indptr, indices, distances
+
+def parse_range(args):
+
+    import numpy as np
+
+    roi_file, start, stop = args
+    with open(roi_file, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(stop - start)
+    #files written on windows end their lines with \r\n
+    if b'\r' in chunk:
+        chunk = chunk.replace(b'\r', b'')
+    chunk = chunk.rstrip(b'\n')
+
+    #number of vertex,distance pairs on every line from the comma count between newlines
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    commas = np.searchsorted(np.flatnonzero(buf == ord(',')), newlines)
+    fields = np.diff(np.concatenate(([0], commas, [np.count_nonzero(buf == ord(','))]))) + 1
+    if np.any(fields % 2):
+        raise RuntimeError('malformed geodesic distance line, odd number of fields')
+
+    values = np.fromstring(chunk.replace(b'\n', b','), sep=',')
+    if len(values) != fields.sum():
+        raise RuntimeError('malformed geodesic distance line, could not parse all fields')
+    counts = fields // 2
+    indices = np.int32(values[0::2])
+    distances = np.float32(values[1::2])
+
+    #sort every row by vertex
+    rows = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    order = np.argsort(rows * (indices.max() + 1) + indices, kind='stable')
+    return counts, indices[order], distances[order]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent runner for external commands (wb_command), with exit code checking
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# default number of commands or pool processes a job runs at the same time, None for the
+# physical core count, batches divide the cores between the jobs that run side by side
+max_workers = None
+
+
+def worker_count():
+    """
+    max_workers, or the physical core count if it is not set
+    """
+
+    import psutil
+
+    if max_workers is not None:
+        return max_workers
+    return psutil.cpu_count(logical=False)
+
+
+def pool_context():
+    """
+    start method of the process pools: stages and batch jobs run on threads, and a fork
+    of a multithreaded process can copy locks other threads are holding, so spawn
+    """
+
+    import multiprocessing
+
+    return multiprocessing.get_context('spawn')
+
+
+def stop(state, locked=False):
+    """
+    mark the run as failed and terminate the commands still running
+    """
+
+    if not locked:
+        with state['lock']:
+            return stop(state, locked=True)
+    state['failed'] = True
+    for process in state['running']:
+        # the whole process group, the shell may not exec the command itself
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def run_command(command, state):
+    """
+    run one shell command unless another one already failed
+    returns the command, its exit code, stderr and wall time in seconds
+    """
+
+    with state['lock']:
+        if state['failed']:
+            return None
+        start = time.time()
+        process = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE, start_new_session=True)
+        state['running'].append(process)
+    _, stderr = process.communicate()
+    with state['lock']:
+        state['running'].remove(process)
+        # the first failure stops the commands still running, queued ones never start
+        if process.returncode != 0 and not state['failed']:
+            stop(state, locked=True)
+        elif state['failed']:
+            return None
+
+    return command, process.returncode, stderr.decode(errors='replace'), time.time() - start
+
+
+def run_commands(commands, workers=None):
+    """
+    run independent shell commands concurrently, at most workers at a time
+    the wall time of every command is printed; the first command that fails stops the
+    others and raises a RuntimeError with its exit code and stderr
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if workers is None:
+        workers = worker_count()
+
+    state = {'lock': threading.Lock(), 'failed': False, 'running': []}
+    failure = None
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(commands)))) as executor:
+        futures = [executor.submit(run_command, command, state) for command in commands]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                if result is None:
+                    continue
+                command, code, stderr, seconds = result
+                if code != 0:
+                    failure = result
+                    continue
+                # keep warnings of successful commands in the log
+                if stderr:
+                    sys.stderr.write(stderr)
+                sys.stdout.write('{t:.2f} s: {c}\n'.format(t=seconds, c=command))
+        except BaseException:
+            # e.g. ctrl-c, the commands run in their own sessions and would outlive us
+            stop(state)
+            raise
+
+    if failure is not None:
+        command, code, stderr, seconds = failure
+        raise RuntimeError('command failed with exit code {e} after {t:.2f} s: {c}\n{s}'.format(e=code, t=seconds, c=command, s=stderr))
+
+
+def run(command):
+    """
+    run a single shell command, raising a RuntimeError if it fails
+    """
+
+    run_commands([command], workers=1)
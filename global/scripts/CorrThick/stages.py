@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dependency graph of pipeline stages with checkpoints. A stage is keyed by its name, its
+parameters, the contents of its external input files and the runs of the stages it runs
+after; it is skipped when its key matches its last successful run and its outputs exist.
+Every successful run gets a new run id, so a stage that reruns also reruns everything
+after it.
+"""
+
+import os
+import sys
+import time
+import uuid
+import collections
+import cache
+
+# run: function without arguments that writes the outputs
+# after: names of the stages whose outputs it reads
+# inputs: files it reads that no stage writes, hashed by content
+# outputs: files it writes, all must exist for the stage to be skipped
+# params: values that change its result
+Stage = collections.namedtuple('Stage', ['name', 'run', 'after', 'inputs', 'outputs', 'params'])
+
+
+def stage_key(stage, runs):
+
+    return cache.array_hash(
+        stage.name,
+        stage.params,
+        [runs[name] for name in stage.after],
+        [cache.file_hash(f) for f in stage.inputs],
+    )
+
+
+def record_file(checkpoint_dir, name):
+
+    return os.path.join(checkpoint_dir, '{n}.stage'.format(n=name))
+
+
+def last_run(stage, key, checkpoint_dir):
+    """
+    run id of the last successful run of the stage with this key, None if it has to run
+    """
+
+    if not all(os.path.exists(f) for f in stage.outputs):
+        return None
+    try:
+        with open(record_file(checkpoint_dir, stage.name)) as f:
+            record = f.read().split()
+    except OSError:
+        return None
+    if len(record) != 2 or record[0] != key:
+        return None
+    return record[1]
+
+
+def run_stage(stage, key, checkpoint_dir, label=''):
+    """
+    run a stage unless it is up to date, and record its key once it has succeeded
+    returns the run id
+    """
+
+    # one write per line, stages report from several threads
+    run_id = last_run(stage, key, checkpoint_dir)
+    if run_id is not None:
+        sys.stdout.write('{l}{n}: up to date, skipped\n'.format(l=label, n=stage.name))
+        return run_id
+
+    # a stage that fails or is interrupted is never taken as up to date
+    record = record_file(checkpoint_dir, stage.name)
+    if os.path.exists(record):
+        os.remove(record)
+
+    start = time.time()
+    stage.run()
+
+    run_id = uuid.uuid4().hex
+    tmp_file = '{f}.{pid}.tmp'.format(f=record, pid=os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write('{k} {r}\n'.format(k=key, r=run_id))
+    os.replace(tmp_file, record)
+    sys.stdout.write('{l}{n}: {t:.2f} s\n'.format(l=label, n=stage.name, t=time.time() - start))
+    return run_id
+
+
+def run_stages(stages, checkpoint_dir, max_workers=None, label=''):
+    """
+    run stages in dependency order, every stage as soon as the stages it runs after are
+    done, so independent stages run at the same time (in threads, most of the work is in
+    numpy, process pools and external commands)
+    the first failure lets the running stages finish, starts no new ones, and is raised
+    label: prefix of the progress lines, e.g. the subject and hemisphere of a batch
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    names = [stage.name for stage in stages]
+    for stage in stages:
+        for name in stage.after:
+            if name not in names:
+                raise ValueError("stage '{s}' runs after unknown stage '{n}'".format(s=stage.name, n=name))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    keys = {}
+    runs = {}
+    running = {}
+    failure = None
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        while True:
+            if failure is None:
+                for stage in stages:
+                    if stage.name not in keys and all(name in runs for name in stage.after):
+                        try:
+                            keys[stage.name] = stage_key(stage, runs)
+                        except OSError as e:
+                            failure = e
+                            break
+                        running[executor.submit(run_stage, stage, keys[stage.name], checkpoint_dir, label)] = stage.name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    runs[name] = future.result()
+                except Exception as e:
+                    if failure is None:
+                        failure = e
+
+    if failure is not None:
+        raise failure
+    if len(runs) < len(stages):
+        raise RuntimeError('circular stage dependencies: {s}'.format(s=[n for n in names if n not in runs]))
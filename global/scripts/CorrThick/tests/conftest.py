@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the CorrThick modules import each other by their flat names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
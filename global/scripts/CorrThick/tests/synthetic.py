@@ -0,0 +1,70 @@
+"""
+Small synthetic surfaces and maps for the tests
+"""
+
+import numpy as np
+
+
+def icosphere(subdivisions, radius=100.0):
+    """
+    icosahedron with every triangle split in four per subdivision, projected on a sphere
+    returns vertex coordinates (n, 3) and triangles (m, 3) wound outwards
+    """
+    t = (1 + 5**0.5) / 2
+    coords = [
+        (-1, t, 0), (1, t, 0), (-1, -t, 0), (1, -t, 0),
+        (0, -1, t), (0, 1, t), (0, -1, -t), (0, 1, -t),
+        (t, 0, -1), (t, 0, 1), (-t, 0, -1), (-t, 0, 1),
+    ]
+    triangles = [
+        (0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+        (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+        (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+        (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1),
+    ]
+    coords = [np.array(v, dtype=float) for v in coords]
+    for _ in range(subdivisions):
+        midpoints = {}
+
+        def midpoint(i, j):
+            key = (min(i, j), max(i, j))
+            if key not in midpoints:
+                midpoints[key] = len(coords)
+                coords.append((coords[i] + coords[j]) / 2)
+            return midpoints[key]
+
+        split = []
+        for a, b, c in triangles:
+            ab, bc, ca = midpoint(a, b), midpoint(b, c), midpoint(c, a)
+            split += [(a, ab, ca), (b, bc, ab), (c, ca, bc), (ab, bc, ca)]
+        triangles = split
+    coords = np.array(coords)
+    coords *= radius / np.linalg.norm(coords, axis=1)[:, np.newaxis]
+    return coords, np.array(triangles, dtype=np.int32)
+
+
+def curvature_maps(coords, seed=0, zero_fraction=0.05):
+    """
+    smooth random curvature-like maps and thickness on the vertices, in the form
+    metric_regression reads them (float32 as loaded from gifti, squares included)
+    """
+    rng = np.random.default_rng(seed)
+    unit = coords / np.linalg.norm(coords, axis=1)[:, np.newaxis]
+
+    def field():
+        # a few random low-frequency waves plus noise
+        waves = rng.normal(size=(4, 3)) * 3
+        phase = rng.uniform(0, 2 * np.pi, 4)
+        return np.sin(unit @ waves.T + phase).sum(axis=1) + 0.3 * rng.normal(size=len(unit))
+
+    d = {name: np.float32(0.1 * field()) for name in ["H", "K", "k1", "k2", "SI", "C"]}
+    # squares are named k12, k22, K2, ... as in the gifti outputs
+    for name in ["H", "K", "k1", "k2", "SI", "C"]:
+        d[name + "2"] = d[name] ** 2
+    t = np.float32(2.5 + 0.3 * field())
+    # the medial wall has zero thickness and curvature
+    t[rng.random(len(t)) < zero_fraction] = 0
+    for name in d:
+        d[name][t == 0] = 0
+    d["t"] = t
+    return d
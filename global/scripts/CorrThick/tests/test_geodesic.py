@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import dijkstra
+
+import geodesic
+from synthetic import icosphere
+
+RADIUS = 100.0
+LIMIT = 20.0
+
+
+@pytest.fixture(scope="module")
+def sphere():
+    coords, triangles = icosphere(4, RADIUS)
+    # small blocks so the sphere is split into many searches
+    serial = geodesic.geodesic_distances(*coords.T, *triangles.T, LIMIT, max_workers=1, block=64)
+    return coords, triangles, serial
+
+
+def test_pool_matches_serial(sphere):
+    coords, triangles, serial = sphere
+    pooled = geodesic.geodesic_distances(*coords.T, *triangles.T, LIMIT, max_workers=2, block=64)
+    for s, p in zip(serial, pooled):
+        np.testing.assert_array_equal(p, s)
+
+
+def test_restricted_search_matches_whole_graph(sphere):
+    coords, triangles, (indptr, indices, distances) = sphere
+    graph = geodesic.surface_graph(coords, *triangles.T)
+    full = dijkstra(graph, directed=True, indices=np.arange(len(coords)), limit=LIMIT)
+    reached = full <= LIMIT
+    np.testing.assert_array_equal(np.diff(indptr), reached.sum(axis=1))
+    np.testing.assert_array_equal(indices, np.nonzero(reached)[1])
+    np.testing.assert_array_equal(distances, np.float32(full[reached]))
+
+
+def test_distances_near_great_circle(sphere):
+    coords, _, (indptr, indices, distances) = sphere
+    rows = np.repeat(np.arange(len(coords)), np.diff(indptr))
+    others = rows != indices
+    np.testing.assert_array_equal(distances[~others], 0)
+
+    unit = coords / RADIUS
+    cosine = np.clip(np.sum(unit[rows] * unit[indices], axis=1), -1, 1)
+    great_circle = RADIUS * np.arccos(cosine)[others]
+    chord = np.linalg.norm(coords[rows] - coords[indices], axis=1)[others]
+    d = distances[others]
+    # paths on the inscribed mesh are never shorter than the straight line, and the
+    # edge graph with the unfolded paths across triangle pairs stays within 5% of the arc
+    assert np.all(d >= chord * (1 - 1e-6))
+    assert np.all(d <= great_circle * 1.05)
+    # every vertex within the limit along the arc, less the mesh error, is found
+    assert np.all(np.diff(indptr) >= 1)
+    within = np.flatnonzero(np.arccos(np.clip(unit @ unit[0], -1, 1)) * RADIUS < LIMIT / 1.05)
+    assert np.all(np.isin(within, indices[indptr[0] : indptr[1]]))
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+import scipy.stats as stats
+
+import metric_regression
+import roi
+from synthetic import curvature_maps, icosphere
+
+
+def inverse_regression(j, region, weight, d):
+    """
+    the per-vertex fit as it was before batching: drop the zero-thickness rows and
+    invert the 11x11 normal matrix of one patch
+    """
+    curv_matrix = np.array([d[r][region] for r in metric_regression.regressors], dtype=float)
+    t = np.asarray(d["t"][region], dtype=float)
+    sqrt_w = np.sqrt(weight)
+
+    weighted = curv_matrix * sqrt_w
+    weighted = np.delete(weighted, np.argwhere(np.all(weighted == 0, axis=0)), axis=1)
+    t_w = t * sqrt_w
+    ones = np.where(t_w == 0, 0, sqrt_w)
+    design = np.vstack((weighted, ones[ones != 0]))
+    coeff = np.linalg.inv(design @ design.T) @ (design @ t_w[t_w != 0])
+
+    coeff_norm = coeff[:-1] * stats.median_abs_deviation(curv_matrix, axis=1)
+    t_corr = float((t - coeff[:-1] @ curv_matrix)[region == j][0])
+    return coeff, coeff_norm, t_corr
+
+
+@pytest.fixture(scope="module")
+def patches():
+    coords, triangles = icosphere(4)
+    rois = roi.geodesic_roi(*coords.T, *triangles.T, 10)
+    d = curvature_maps(coords)
+    centers = np.flatnonzero(d["t"] != 0)
+    return d, rois, centers
+
+
+def reference(d, rois, centers):
+    fits = [
+        inverse_regression(
+            j,
+            rois.indices[rois.indptr[j] : rois.indptr[j + 1]],
+            rois.weights[rois.indptr[j] : rois.indptr[j + 1]],
+            d,
+        )
+        for j in centers
+    ]
+    return [np.array(a) for a in zip(*fits)]
+
+
+def test_batched_matches_inverse_after_float32(patches):
+    d, rois, centers = patches
+    expected = reference(d, rois, centers)
+    result = metric_regression.batched_regression(d, rois, centers)
+    # the outputs are saved as float32 gifti
+    for e, r in zip(expected, result):
+        np.testing.assert_array_equal(np.float32(r), np.float32(e))
+
+
+def test_small_blocks_give_the_same_fit(patches):
+    # patch_blocks must size each block by its widest patch, whatever the budget,
+    # the padding width only changes the summation order
+    d, rois, centers = patches
+    X, t = metric_regression.design_matrix(d)
+    indptr, indices, weights = metric_regression.patch_csr(rois, centers)
+    whole = metric_regression.solve_patches(X, t, centers, indptr, indices, weights)
+    blocked = metric_regression.solve_patches(
+        X, t, centers, indptr, indices, weights, block_bytes=2**14
+    )
+    for a, b in zip(whole, blocked):
+        np.testing.assert_allclose(b, a, rtol=1e-9, atol=1e-12)
+
+
+def test_patch_blocks_fit_the_budget():
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(1, 300, 1000)
+    indptr = np.concatenate(([0], np.cumsum(sizes)))
+    row_bytes, block_bytes = 88, 88 * 2000
+    seen = []
+    for block, n, valid, pos in metric_regression.patch_blocks(indptr, row_bytes, block_bytes):
+        np.testing.assert_array_equal(n, sizes[block])
+        assert valid.shape == pos.shape == (len(block), n.max())
+        # the padded block stays within the budget unless a single patch exceeds it
+        assert len(block) == 1 or pos.size * row_bytes <= block_bytes
+        seen.append(block)
+    np.testing.assert_array_equal(np.sort(np.concatenate(seen)), np.arange(len(sizes)))
+
+
+# sparse_regression sums the normal equations in another order, documented in --regression-method
+SPARSE_TOLERANCE = 1e-3
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_sparse_within_tolerance_of_batched(patches, seed):
+    _, rois, _ = patches
+    d = curvature_maps(icosphere(4)[0], seed=seed)
+    centers = np.flatnonzero(d["t"] != 0)
+    batched = metric_regression.batched_regression(d, rois, centers)
+    sparse = metric_regression.sparse_regression(d, rois, centers)
+    for b, s in zip(batched, sparse):
+        assert np.max(np.abs(s - b)) <= SPARSE_TOLERANCE * np.max(np.abs(b))
+
+
+def test_pool_matches_batched(patches):
+    d, rois, centers = patches
+    batched = metric_regression.batched_regression(d, rois, centers)
+    pooled = metric_regression.pool_regression(d, rois, centers, chunk=500)
+    for b, p in zip(batched, pooled):
+        np.testing.assert_allclose(p, b, rtol=1e-9, atol=1e-12)
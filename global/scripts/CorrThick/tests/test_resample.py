@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+
+import resample
+from synthetic import icosphere
+
+
+def smooth_map(coords):
+    return np.sin(coords[:, 0] / 30) + coords[:, 2] / 100
+
+
+@pytest.mark.parametrize("coarse_to_fine", [True, False])
+def test_adap_bary_area_resamples_smooth_maps(coarse_to_fine):
+    coarse = icosphere(3)
+    # rotated so that no vertices of the two spheres coincide
+    fine_coords, fine_triangles = icosphere(4)
+    fine = (Rotation.from_euler("xyz", [0.3, 0.2, 0.1]).apply(fine_coords), fine_triangles)
+    current, new = (coarse, fine) if coarse_to_fine else (fine, coarse)
+
+    matrix = resample.adap_bary_area(current, new, current)
+
+    assert matrix.shape == (len(new[0]), len(current[0]))
+    np.testing.assert_allclose(matrix.sum(axis=1).A1, 1, rtol=1e-12)
+    assert matrix.min() >= 0
+    # downsampling gathers the current vertices around each new one instead of 3
+    assert matrix.getnnz(axis=1).min() >= (3 if coarse_to_fine else 4)
+    # within 2.5% of the range of the map
+    assert np.max(np.abs(matrix @ smooth_map(current[0]) - smooth_map(new[0]))) < 0.05
+
+
+def test_roi_excludes_vertices():
+    current = icosphere(3)
+    new = icosphere(4)
+    roi = np.ones(len(current[0]))
+    roi[current[0][:, 2] > 50] = 0
+    matrix = resample.adap_bary_area(current, new, current, roi)
+    assert matrix[:, roi == 0].nnz == 0
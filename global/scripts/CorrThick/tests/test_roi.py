@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import roi
+
+
+def per_line(roi_file):
+    """
+    the per-line parser the chunked reader replaced: every row sorted by vertex
+    """
+    rows = []
+    with open(roi_file) as f:
+        for line in f:
+            l = line.split(",")
+            vertices = np.array([int(ele) for ele in l[::2]], dtype=np.int32)
+            distances = np.array([float(ele) for ele in l[1::2]], dtype=np.float32)
+            vertices, distances = zip(*sorted(zip(vertices, distances)))
+            rows.append((np.array(vertices), np.array(distances)))
+    return rows
+
+
+def write_geodesic_text(path, nrows, nvert=5000, seed=0, newline="\n", final_newline=True):
+    rng = np.random.default_rng(seed)
+    lines = []
+    for v in range(nrows):
+        n = rng.integers(1, 30)
+        vertices = rng.choice(nvert, n, replace=False)
+        distances = rng.random(n) * 20
+        lines.append(",".join("{i},{d:.6f}".format(i=i, d=d) for i, d in zip(vertices, distances)))
+    text = newline.join(lines) + (newline if final_newline else "")
+    path.write_bytes(text.encode())
+    return path
+
+
+def assert_same_rows(parsed, rows):
+    indptr, indices, distances = parsed
+    assert len(indptr) - 1 == len(rows)
+    assert indices.dtype == np.int32 and distances.dtype == np.float32
+    for i, (vertices, dist) in enumerate(rows):
+        np.testing.assert_array_equal(indices[indptr[i] : indptr[i + 1]], vertices)
+        np.testing.assert_array_equal(distances[indptr[i] : indptr[i + 1]], dist)
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+@pytest.mark.parametrize("final_newline", [True, False])
+def test_serial_and_parallel_match_per_line_parser(tmp_path, newline, final_newline):
+    roi_file = write_geodesic_text(tmp_path / "roi.csv", 2000, newline=newline, final_newline=final_newline)
+    rows = per_line(roi_file)
+    # odd chunk sizes put most chunk boundaries in the middle of a row
+    for chunk_bytes in (2**26, 4097, 333):
+        serial = roi.read_geodesic_text(roi_file, chunk_bytes=chunk_bytes, max_workers=1)
+        parallel = roi.read_geodesic_text(roi_file, chunk_bytes=chunk_bytes, max_workers=2)
+        assert_same_rows(serial, rows)
+        assert_same_rows(parallel, rows)
+
+
+def test_malformed_line(tmp_path):
+    roi_file = tmp_path / "roi.csv"
+    roi_file.write_bytes(b"1,0.5,2,0.25\n3,0.5,4\n")
+    with pytest.raises(RuntimeError):
+        roi.read_geodesic_text(roi_file, max_workers=1)
+
+
+def subject_roi_file(subjects_dir):
+    folder = subjects_dir / "S" / "MNINonLinear" / "Native" / "CorrThick"
+    folder.mkdir(parents=True)
+    return folder / "S.L.mid.roi.164k.csv"
+
+
+def test_164k_row_count(tmp_path):
+    roi_file = subject_roi_file(tmp_path)
+    roi_file.write_bytes(b"".join(b"%d,0\n" % v for v in range(163842)))
+    rois = roi.roi(str(tmp_path), "S", "L", "mid", "164k", 4)
+    assert len(rois.indptr) - 1 == 163842
+    np.testing.assert_array_equal(rois.indices, np.arange(163842))
+    np.testing.assert_array_equal(rois.weights, 1)
+    # the text file is removed once read
+    assert not roi_file.exists()
+
+
+def test_164k_row_count_mismatch(tmp_path):
+    roi_file = subject_roi_file(tmp_path)
+    roi_file.write_bytes(b"".join(b"%d,0\n" % v for v in range(163841)))
+    with pytest.raises(RuntimeError, match="163841 rows, expected 163842"):
+        roi.roi(str(tmp_path), "S", "L", "mid", "164k", 4)
@@ -0,0 +1,23 @@
+import math
+
+import numpy as np
+
+import geodesic
+import smoothing
+from synthetic import icosphere
+
+
+def test_rows_are_normalized_gaussian_times_area():
+    coords, triangles = icosphere(3)
+    fwhm = 12.0
+    S = smoothing.smoothing_operator(*coords.T, *triangles.T, fwhm)
+
+    np.testing.assert_allclose(S.sum(axis=1).A1, 1, rtol=1e-12)
+    np.testing.assert_allclose(S @ np.full(len(coords), 2.5), 2.5, rtol=1e-12)
+
+    sigma = fwhm / (2 * math.sqrt(2 * math.log(2)))
+    indptr, indices, distances = geodesic.geodesic_distances(*coords.T, *triangles.T, 3 * sigma, max_workers=1)
+    area = smoothing.vertex_areas(coords, triangles)
+    row = indices[indptr[0] : indptr[1]]
+    expected = np.exp(-0.5 * (np.float64(distances[indptr[0] : indptr[1]]) / sigma) ** 2) * area[row]
+    np.testing.assert_allclose(S[0, row].toarray().ravel(), expected / expected.sum(), rtol=1e-12)
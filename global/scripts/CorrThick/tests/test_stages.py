@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+import cache
+import stages
+
+
+class Pipeline:
+    """
+    a -> b -> c and an independent d, every stage writes one file and logs its runs
+    """
+
+    def __init__(self, folder, params=None, fail=()):
+        self.folder = folder
+        self.params = params or {}
+        self.fail = set(fail)
+        self.input = os.path.join(folder, "input.txt")
+        self.ran = []
+
+    def output(self, name):
+        return os.path.join(self.folder, name + ".txt")
+
+    def stage(self, name, after):
+        def run():
+            self.ran.append(name)
+            if name in self.fail:
+                raise RuntimeError("{n} failed".format(n=name))
+            with open(self.output(name), "w") as f:
+                f.write(repr(self.params.get(name)))
+
+        return stages.Stage(name, run, after, [self.input], [self.output(name)], (self.params.get(name),))
+
+    def run(self):
+        graph = [
+            self.stage("a", []),
+            self.stage("b", ["a"]),
+            self.stage("c", ["b"]),
+            self.stage("d", []),
+        ]
+        stages.run_stages(graph, os.path.join(self.folder, "checkpoints"))
+        return sorted(self.ran)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    (tmp_path / "input.txt").write_text("input")
+    return str(tmp_path)
+
+
+def test_up_to_date_stages_are_skipped(folder):
+    assert Pipeline(folder).run() == ["a", "b", "c", "d"]
+    assert Pipeline(folder).run() == []
+
+
+def test_parameter_change_reruns_downstream_only(folder):
+    Pipeline(folder).run()
+    assert Pipeline(folder, params={"b": 2}).run() == ["b", "c"]
+    assert Pipeline(folder, params={"b": 2}).run() == []
+
+
+def test_input_change_and_missing_output_rerun(folder):
+    Pipeline(folder).run()
+    with open(os.path.join(folder, "input.txt"), "w") as f:
+        f.write("changed input")
+    assert Pipeline(folder).run() == ["a", "b", "c", "d"]
+    os.remove(os.path.join(folder, "c.txt"))
+    assert Pipeline(folder).run() == ["c"]
+
+
+def test_failed_stage_resumes_from_that_stage(folder):
+    with pytest.raises(RuntimeError, match="b failed"):
+        Pipeline(folder, fail={"b"}).run()
+    # the stage after the failure never started
+    assert not os.path.exists(os.path.join(folder, "c.txt"))
+    assert Pipeline(folder).run() == ["b", "c"]
+
+
+def test_unknown_dependency(folder):
+    pipeline = Pipeline(folder)
+    with pytest.raises(ValueError):
+        stages.run_stages([pipeline.stage("b", ["a"])], os.path.join(folder, "checkpoints"))
+
+
+def test_evict_removes_oldest_entries_of_known_kinds(tmp_path):
+    entries = []
+    for age, kind, ext in [(5, "rois", "npz"), (4, "topology", "npy"), (3, "resample", "npz"), (2, "topology", "unusual.npy"), (1, "rois", "npz")]:
+        filename = cache.cache_file(str(tmp_path), kind, cache.array_hash(age), ext)
+        with open(filename, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(filename, (1000 - age, 1000 - age))
+        entries.append(filename)
+    # files that are not cache entries are never removed or counted, however old
+    foreign = [tmp_path / "notes.txt", tmp_path / "rois" / "keep.npz", tmp_path / "other" / (cache.array_hash(0) + ".npy")]
+    for filename in foreign:
+        filename.parent.mkdir(exist_ok=True)
+        filename.write_bytes(b"x" * 1000)
+        os.utime(filename, (0, 0))
+
+    cache.evict(str(tmp_path), 250)
+
+    assert [os.path.exists(f) for f in entries] == [False, False, False, True, True]
+    assert all(f.exists() for f in foreign)